@@ -1,19 +1,152 @@
-from datasets import Dataset, load_dataset
-from fast_langdetect import detect
-
-dataset = load_dataset("fal/imgsys-results", split="train")
-dataset = dataset.shuffle()
-df = dataset.to_pandas()
-df = df.drop_duplicates(subset=["prompt"])
-df = df.reset_index(drop=True)
-df = df[["prompt"]]
-df = df.dropna(subset=["prompt"])
-df["language"], df["score"] = zip(
-    *df["prompt"].apply(lambda x: detect(x.replace("\n", "")).values())
-)
-df = df[df["language"] == "en"]
-df = df["prompt"]
-dataset = Dataset.from_pandas(df)
-dataset.push_to_hub(
-    "data-is-better-together/imgsys-results-prompts-shuffled-cleaned-deduplicated-english"
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from huggingface_hub import HfApi, snapshot_download
+
+from language_detection import LanguageDetector
+from near_dedup import MinHashLSH
+from prompt_cleaning import (
+    FingerprintIndex,
+    FingerprintSet,
+    ParquetShardWriter,
+    fingerprint_batch,
+    iter_prompt_batches,
+    normalize_prompt,
 )
+
+SOURCE_REPO_ID = "fal/imgsys-results"
+# Revision of the source dataset, defaults to the latest one and is recorded in the manifest
+SOURCE_REVISION = None
+OUTPUT_REPO_ID = "data-is-better-together/imgsys-results-prompts-shuffled-cleaned-deduplicated-english"
+OUTPUT_DIR = Path("imgsys-results-prompts-cleaned")
+# Stream the prompts from the Hub instead of downloading the dataset first
+STREAMING = False
+BATCH_SIZE = 100_000  # number of prompts held in memory at once
+SHARD_SIZE = 500_000  # number of prompts per output parquet shard
+SEED = 42  # seed of the shuffle, so reruns export the prompts in the same order
+# Number of processes used for language detection, defaults to all the cores
+NUM_PROC = None
+# Jaccard similarity above which two prompts are near-duplicates, set to None to only
+# drop exact duplicates
+NEAR_DEDUP_THRESHOLD = 0.8
+# Only process the source rows added since the previous run and append them as new shards,
+# using the watermark and fingerprints stored next to the previous export
+INCREMENTAL = False
+# Files stored in the output repository to resume from in the next incremental run
+STATE_FILES = [
+    "manifest.json",
+    "seen_fingerprints.npy",
+    "near_dedup_bands.npz",
+    "prompt_fingerprints.npy",
+    "prompt_fingerprint_rows.npy",
+]
+
+if __name__ == "__main__":
+    api = HfApi()
+    source_revision = (
+        SOURCE_REVISION or api.dataset_info(SOURCE_REPO_ID).sha  # type: ignore
+    )
+
+    ## Only the prompt column is read, in batches, and duplicates are tracked with the 64-bit
+    ## fingerprints of the normalized prompts so peak memory does not grow with the size of
+    ## the imgsys snapshot.
+    seen_prompts = FingerprintSet()
+    near_duplicates = (
+        MinHashLSH(threshold=NEAR_DEDUP_THRESHOLD) if NEAR_DEDUP_THRESHOLD else None
+    )
+    previous_manifest = None
+    if INCREMENTAL and api.file_exists(
+        OUTPUT_REPO_ID, "manifest.json", repo_type="dataset"
+    ):
+        snapshot_download(
+            OUTPUT_REPO_ID,
+            repo_type="dataset",
+            local_dir=OUTPUT_DIR,
+            allow_patterns=STATE_FILES,
+        )
+        previous_manifest = ParquetShardWriter.read_manifest(OUTPUT_DIR)
+        if previous_manifest["near_dedup_threshold"] != NEAR_DEDUP_THRESHOLD:
+            raise ValueError(
+                "`NEAR_DEDUP_THRESHOLD` changed since the previous run, run it again"
+                " with `INCREMENTAL = False` to rebuild the dataset."
+            )
+        seen_prompts = FingerprintSet.load(OUTPUT_DIR / "seen_fingerprints.npy")
+        if near_duplicates is not None:
+            near_duplicates.load(OUTPUT_DIR / "near_dedup_bands.npz")
+    processed_rows = previous_manifest["source_num_rows"] if previous_manifest else 0
+
+    exported_fingerprints = []
+    language_detector = LanguageDetector(num_proc=NUM_PROC)
+    with ParquetShardWriter(
+        OUTPUT_DIR,
+        shard_size=SHARD_SIZE,
+        shards=previous_manifest["shards"] if previous_manifest else None,
+    ) as writer:
+        for prompts in iter_prompt_batches(
+            SOURCE_REPO_ID,
+            revision=source_revision,
+            batch_size=BATCH_SIZE,
+            streaming=STREAMING,
+            seed=SEED,
+            skip_rows=processed_rows,
+        ):
+            processed_rows += len(prompts)
+            prompts = [prompt for prompt in prompts if prompt is not None]
+            normalized_prompts = [normalize_prompt(prompt) for prompt in prompts]
+            fingerprints = fingerprint_batch(normalized_prompts)
+            is_new = seen_prompts.add(fingerprints)
+            table = pa.table(
+                {
+                    "prompt": pa.array(prompts, pa.string()),
+                    "normalized_prompt": pa.array(normalized_prompts, pa.string()),
+                    "prompt_fingerprint": pa.array(fingerprints, pa.uint64()),
+                }
+            ).filter(is_new)
+            languages, _ = language_detector.detect(table["prompt"].to_pylist())
+            table = table.filter(pc.equal(languages, "en"))
+            ## Prompts only differing by casing, punctuation or a few words would cost
+            ## four image generations each, so they are dropped before generation.
+            if near_duplicates is not None:
+                table = table.filter(near_duplicates.add(table["prompt"].to_pylist()))
+            writer.write(table)
+            exported_fingerprints.append(table["prompt_fingerprint"].to_numpy())
+    language_detector.close()
+    if previous_manifest and processed_rows == previous_manifest["source_num_rows"]:
+        ## Nothing was added to the source since the previous run, which is kept as is
+        print(f"No new rows in '{SOURCE_REPO_ID}' since the previous run.")
+        sys.exit()
+
+    writer.write_manifest(
+        source_repo_id=SOURCE_REPO_ID,
+        source_revision=source_revision,
+        source_num_rows=processed_rows,
+        seed=SEED,
+        near_dedup_threshold=NEAR_DEDUP_THRESHOLD,
+    )
+    seen_prompts.save(OUTPUT_DIR / "seen_fingerprints.npy")
+    if near_duplicates is not None:
+        near_duplicates.save(OUTPUT_DIR / "near_dedup_bands.npz")
+    ## Sorted fingerprint -> row index, so later stages can look up or join prompts
+    ## against this dataset with a binary search over a memory-mapped array.
+    new_fingerprints = (
+        np.concatenate(exported_fingerprints)
+        if exported_fingerprints
+        else np.empty(0, dtype=np.uint64)
+    )
+    if previous_manifest:
+        FingerprintIndex.load(OUTPUT_DIR).extend(new_fingerprints).save(OUTPUT_DIR)
+    else:
+        FingerprintIndex.from_fingerprints(new_fingerprints).save(OUTPUT_DIR)
+
+    ## A full run replaces all the shards, an incremental one only uploads the new shards
+    ## and the updated state files.
+    api.create_repo(OUTPUT_REPO_ID, repo_type="dataset", exist_ok=True)
+    api.upload_folder(
+        repo_id=OUTPUT_REPO_ID,
+        repo_type="dataset",
+        folder_path=OUTPUT_DIR,
+        delete_patterns=None if previous_manifest else ["data/*"],
+    )
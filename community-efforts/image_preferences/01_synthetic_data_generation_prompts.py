@@ -1,222 +1,47 @@
+import json
 import os
-import random
+import re
+from typing import Any, Dict, List, Optional
 
 os.environ["DISTILABEL_LOG_LEVEL"] = "DEBUG"
 
-from distilabel.llms import InferenceEndpointsLLM
-
 # from distilabel.llms.huggingface import InferenceEndpointsLLM
 from distilabel.pipeline import Pipeline
-from distilabel.steps import GroupColumns, KeepColumns, LoadDataFromHub, StepInput, step
+from distilabel.steps import GroupColumns, KeepColumns, LoadDataFromHub, StepInput
 from distilabel.steps.base import StepInput
-from distilabel.steps.tasks import TextGeneration
+from distilabel.steps.tasks import Task, TextGeneration
+from distilabel.steps.tasks.typing import ChatType
 from distilabel.steps.typing import StepOutput
+from jinja2 import Template
+from pydantic import PrivateAttr
 
-## At the time of writing this, the distilabel library does not support the image generation endpoint.
-## This is a temporary fix to allow us to use the image generation endpoint.
-
-## Let's determine the categories and subcategories for the image generation task
-# https://huggingface.co/spaces/google/sdxl/blob/main/app.py#L55
-categories = {
-    # included
-    "Cinematic": [
-        # included
-        "emotional",
-        "harmonious",
-        "vignette",
-        "highly detailed",
-        "high budget",
-        "bokeh",
-        "cinemascope",
-        "moody",
-        "epic",
-        "gorgeous",
-        "film grain",
-        "grainy",
-    ],
-    # included
-    "Photographic": [
-        # included
-        "film",
-        "bokeh",
-        "professional",
-        "4k",
-        "highly detailed",
-        ## not included
-        "Landscape",
-        "Portrait",
-        "Macro",
-        "Portra",
-        "Gold",
-        "ColorPlus",
-        "Ektar",
-        "Superia",
-        "C200",
-        "CineStill",
-        "CineStill 50D",
-        "CineStill 800T",
-        "Tri-X",
-        "HP5",
-        "Delta",
-        "T-Max",
-        "Fomapan",
-        "StreetPan",
-        "Provia",
-        "Ektachrome",
-        "Velvia",
-    ],
-    # included
-    "Anime": [
-        # included
-        "anime style",
-        "key visual",
-        "vibrant",
-        "studio anime",
-        "highly detailed",
-    ],
-    # included
-    "Manga": [
-        # included
-        "vibrant",
-        "high-energy",
-        "detailed",
-        "iconic",
-        "Japanese comic style",
-    ],
-    # included
-    "Digital art": [
-        # included
-        "digital artwork",
-        "illustrative",
-        "painterly",
-        "matte painting",
-        "highly detailed",
-    ],
-    # included
-    "Pixel art": [
-        # included
-        "low-res",
-        "blocky",
-        "pixel art style",
-        "8-bit graphics",
-    ],
-    # included
-    "Fantasy art": [
-        # included
-        "magnificent",
-        "celestial",
-        "ethereal",
-        "painterly",
-        "epic",
-        "majestic",
-        "magical",
-        "fantasy art",
-        "cover art",
-        "dreamy",
-    ],
-    # included
-    "Neonpunk": [
-        # included
-        "cyberpunk",
-        "vaporwave",
-        "neon",
-        "vibes",
-        "vibrant",
-        "stunningly beautiful",
-        "crisp",
-        "detailed",
-        "sleek",
-        "ultramodern",
-        "magenta highlights",
-        "dark purple shadows",
-        "high contrast",
-        "cinematic",
-        "ultra detailed",
-        "intricate",
-        "professional",
-    ],
-    # included
-    "3D Model": [
-        # included
-        "octane render",
-        "highly detailed",
-        "volumetric",
-        "dramatic lighting",
-    ],
-    # not included
-    "Painting": [
-        "Oil",
-        "Acrylic",
-        "Watercolor",
-        "Digital",
-        "Mural",
-        "Sketch",
-        "Gouache",
-        "Renaissance",
-        "Baroque",
-        "Romanticism",
-        "Impressionism",
-        "Expressionism",
-        "Cubism",
-        "Surrealism",
-        "Pop Art",
-        "Minimalism",
-        "Realism",
-        "Encaustic",
-        "Tempera",
-        "Fresco",
-        "Ink Wash",
-        "Spray Paint",
-        "Mixed Media",
-    ],
-    # not included
-    "Animation": [
-        # not included
-        "Animation",
-        "Stop motion",
-        "Claymation",
-        "Pixel Art",
-        "Vector",
-        "Hand-drawn",
-        "Cutout",
-        "Whiteboard",
-    ],
-    # not included
-    "Illustration": [
-        # not included
-        "Book",
-        "Comics",
-        "Editorial",
-        "Advertising",
-        "Technical",
-        "Fantasy",
-        "Scientific",
-        "Fashion",
-        "Storyboard",
-        "Concept Art",
-        "Manga",
-        "Anime",
-        "Digital",
-        "Vector",
-        "Design",
-    ],
-}
+from categories import categories, excluded_categories
+from category_selector import CategorySelector
+from llms import CachedConcurrentInferenceEndpointsLLM
 
 ## We will use the Qwen2.5-72B-Instruct model for the text generation task, this will help us to generate the quality and style prompts
 
 model_id = (
-    "meta-llama/Llama-3.1-8B-Instruct"
-)  # "meta-llama/Meta-Llama-3.1-70B-Instruct"
+    "meta-llama/Llama-3.1-8B-Instruct"  # "meta-llama/Meta-Llama-3.1-70B-Instruct"
+)
 
 
-llm = InferenceEndpointsLLM(
+# Responses are cached on disk by endpoint, prompt and generation kwargs, so rerunning the
+# pipeline after a crash or a change in the downstream steps does not request them again
+RESPONSE_CACHE_PATH = "cache/responses.sqlite"
+
+llm = CachedConcurrentInferenceEndpointsLLM(
     # model_id=model_id,
     # tokenizer_id=model_id,
     generation_kwargs={"temperature": 0.8, "max_new_tokens": 2048},
     base_url="https://rti2mzernqmo00qy.us-east-1.aws.endpoints.huggingface.cloud",
     api_key=os.getenv("HF_TOKEN"),
+    cache_path=RESPONSE_CACHE_PATH,
 )
 
+# Generate the quality and simplified prompts with a single request per row, falling back to
+# one request per prompt when the response cannot be parsed
+COMBINED_AUGMENTATION = True
 
 ## We will use two types of prompts: quality and style. The quality prompt will help us to generate the quality-enhanced prompts and the style prompt will help us to generate the style-enhanced prompts.
 quality_prompt = """
@@ -284,30 +109,148 @@ Follow these guidelines:
 ## Simplified Description
 """
 
+## The quality and simplification prompts both rewrite the style prompt, so they can be
+## requested at once as a JSON object, sending the style prompt to the model only once.
+quality_and_simplification_prompt = """
+You are an expert at refining prompts for image generation models. Your task is to write two new versions of the given prompt: a quality-enhanced prompt and a simplified prompt.
+
+For the quality-enhanced prompt, enhance the given prompt by adding descriptive details and quality-improving elements, while maintaining the original intent and core concept:
+1. Preserve the main subject and action of the original prompt.
+2. Add specific, vivid details to enhance visual clarity.
+3. Incorporate elements that improve overall image quality and aesthetics.
+4. Keep the prompt concise and avoid unnecessary words.
+5. Use modifiers that are appropriate for the subject matter.
+
+Example modifiers (use as reference, adapt based on some aspect that's suitable for the original prompt):
+- Lighting: "soft golden hour light", "dramatic chiaroscuro", "ethereal glow"
+- Composition: "rule of thirds", "dynamic perspective", "symmetrical balance"
+- Texture: "intricate details", "smooth gradients", "rich textures"
+- Color: "vibrant color palette", "monochromatic scheme", "complementary colors"
+- Atmosphere: "misty ambiance", "serene mood", "energetic atmosphere"
+- Technical: "high resolution", "photorealistic", "sharp focus"
+
+The enhanced prompt should be short, concise, direct, avoid unnecessary words and written as it was a human expert writing the prompt.
+
+For the simplified prompt, simplify the description by removing any unnecessary words and phrases, while maintaining the original intent and core concept of the description:
+1. Preserve the main subject of the original description.
+2. Remove all any unnecessary words and phrases.
+3. Ensure the simplified description could have been quickly written by a human.
+
+Output only a JSON object with the keys "quality_prompt" and "simplified_prompt", without any additional text or explanations.
+
+## Original Prompt
+{{ style_prompt }}
+
+## JSON
+"""
+
+
+class QualityAndSimplificationGeneration(Task):
+    """Generates the quality-enhanced and simplified prompts with a single request returning
+    both in a JSON object. The rows whose response is not a valid JSON object with both
+    prompts are generated again with one request per prompt, using `quality_template` and
+    `simplification_template`."""
+
+    template: str = quality_and_simplification_prompt
+    quality_template: str = quality_prompt
+    simplification_template: str = simplification_prompt
+
+    _template: Optional[Template] = PrivateAttr(default=None)
+    _quality_template: Optional[Template] = PrivateAttr(default=None)
+    _simplification_template: Optional[Template] = PrivateAttr(default=None)
+
+    def load(self) -> None:
+        super().load()
+        self._template = Template(self.template)
+        self._quality_template = Template(self.quality_template)
+        self._simplification_template = Template(self.simplification_template)
+
+    @property
+    def inputs(self) -> List[str]:
+        return ["style_prompt"]
+
+    @property
+    def outputs(self) -> List[str]:
+        return ["quality_prompt", "simplified_prompt", "model_name"]
+
+    def format_input(self, input: Dict[str, Any]) -> "ChatType":
+        return [{"role": "user", "content": self._template.render(**input)}]
+
+    def format_output(
+        self, output: Optional[str], input: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Parses the JSON object of the response, returning `None` for both prompts if it
+        is missing, malformed or any of the prompts is empty."""
+        empty = {"quality_prompt": None, "simplified_prompt": None}
+        match = re.search(r"\{.*\}", output or "", re.DOTALL)
+        if match is None:
+            return empty
+        try:
+            parsed = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return empty
+        if not isinstance(parsed, dict):
+            return empty
+        prompts = {key: parsed.get(key) for key in empty}
+        if not all(
+            isinstance(prompt, str) and prompt.strip() for prompt in prompts.values()
+        ):
+            return empty
+        return {key: prompt.strip() for key, prompt in prompts.items()}
+
+    def process(self, inputs: StepInput) -> "StepOutput":  # type: ignore
+        outputs = self.llm.generate_outputs(
+            inputs=self._format_inputs(inputs),
+            num_generations=1,
+            **self.llm.get_generation_kwargs(),
+        )
+        results = [
+            self.format_output(output[0], input)
+            for input, output in zip(inputs, outputs)
+        ]
+
+        failed = [
+            i for i, result in enumerate(results) if result["quality_prompt"] is None
+        ]
+        if failed:
+            self._logger.warning(
+                f"Falling back to one request per prompt for {len(failed)} rows whose"
+                " response is not a valid JSON object."
+            )
+            fallback_outputs = self.llm.generate_outputs(
+                inputs=[
+                    [{"role": "user", "content": template.render(**inputs[i])}]
+                    for template in (
+                        self._quality_template,
+                        self._simplification_template,
+                    )
+                    for i in failed
+                ],
+                num_generations=1,
+                **self.llm.get_generation_kwargs(),
+            )
+            for position, i in enumerate(failed):
+                results[i] = {
+                    "quality_prompt": fallback_outputs[position][0],
+                    "simplified_prompt": fallback_outputs[len(failed) + position][0],
+                }
+
+        for input, result in zip(inputs, results):
+            input.update(result)
+            input["model_name"] = self.llm.model_name
+        yield inputs
+
+
 ## Let's create the pipeline to generate the quality and style prompts
 
 with Pipeline(name="image_preferences_synthetic_data_generation") as pipeline:
     load_data = LoadDataFromHub(name="load_dataset")
 
-    @step(inputs=["prompt"], outputs=["category", "subcategory", "prompt"])
-    def CategorySelector(inputs: StepInput) -> "StepOutput":
-        result = []
-        for input in inputs:
-            # Randomly select a category
-            category = random.choice(list(categories.keys()))
-            # Randomly select a subcategory from the chosen category
-            subcategory = random.choice(categories[category])
-
-            result.append(
-                {
-                    "category": category,
-                    "subcategory": subcategory,
-                    "prompt": input["prompt"],
-                }
-            )
-        yield result
-
-    category_selector = CategorySelector(name="category_selector")
+    category_selector = CategorySelector(
+        name="category_selector",
+        categories=categories,
+        excluded=excluded_categories,
+    )
 
     style_augmentation = TextGeneration(
         llm=llm,
@@ -315,28 +258,9 @@ with Pipeline(name="image_preferences_synthetic_data_generation") as pipeline:
         columns=["prompt", "category", "subcategory"],
         name="style_augmentation",
         output_mappings={"generation": "style_prompt"},
-        input_batch_size=4,
-    )
-
-    simplification_augmentation = TextGeneration(
-        llm=llm,
-        template=simplification_prompt,
-        columns=["style_prompt"],
-        name="simplification_augmentation",
-        output_mappings={"generation": "simplified_prompt"},
-        input_batch_size=2,
-    )
-
-    quality_augmentation = TextGeneration(
-        llm=llm,
-        template=quality_prompt,
-        columns=["style_prompt"],
-        name="quality_augmentation",
-        output_mappings={"generation": "quality_prompt"},
-        input_batch_size=2,
+        input_batch_size=64,
     )
 
-    group_columns = GroupColumns(columns=["model_name"])
     keep_columns = KeepColumns(
         columns=[
             "prompt",
@@ -348,26 +272,76 @@ with Pipeline(name="image_preferences_synthetic_data_generation") as pipeline:
         ]
     )
 
-    (
-        load_data
-        >> category_selector
-        >> style_augmentation
-        >> [quality_augmentation, simplification_augmentation]
-        >> group_columns
-        >> keep_columns
-    )
+    if COMBINED_AUGMENTATION:
+        quality_and_simplification_augmentation = QualityAndSimplificationGeneration(
+            llm=llm,
+            name="quality_and_simplification_augmentation",
+            input_batch_size=64,
+        )
+
+        (
+            load_data
+            >> category_selector
+            >> style_augmentation
+            >> quality_and_simplification_augmentation
+            >> keep_columns
+        )
+    else:
+        simplification_augmentation = TextGeneration(
+            llm=llm,
+            template=simplification_prompt,
+            columns=["style_prompt"],
+            name="simplification_augmentation",
+            output_mappings={"generation": "simplified_prompt"},
+            input_batch_size=64,
+        )
+
+        quality_augmentation = TextGeneration(
+            llm=llm,
+            template=quality_prompt,
+            columns=["style_prompt"],
+            name="quality_augmentation",
+            output_mappings={"generation": "quality_prompt"},
+            input_batch_size=64,
+        )
+
+        group_columns = GroupColumns(columns=["model_name"])
+
+        (
+            load_data
+            >> category_selector
+            >> style_augmentation
+            >> [quality_augmentation, simplification_augmentation]
+            >> group_columns
+            >> keep_columns
+        )
 
 ## Let's run the pipeline and push the resulting dataset to the hub
 
 if __name__ == "__main__":
     num_examples = 15000
+    ## The steps share the same endpoint, so their concurrent requests add up: the style
+    ## step gets half of them as the other steps depend on its output.
+    if COMBINED_AUGMENTATION:
+        augmentation_parameters = {
+            quality_and_simplification_augmentation.name: {
+                "llm": {"max_concurrent_requests": 32}
+            },
+        }
+    else:
+        augmentation_parameters = {
+            quality_augmentation.name: {"llm": {"max_concurrent_requests": 16}},
+            simplification_augmentation.name: {"llm": {"max_concurrent_requests": 16}},
+        }
     distiset = pipeline.run(
         use_cache=True,
         parameters={
             load_data.name: {
                 "num_examples": num_examples,
                 "repo_id": "data-is-better-together/imgsys-results-prompts-shuffled-cleaned-deduplicated-english",
-            }
+            },
+            style_augmentation.name: {"llm": {"max_concurrent_requests": 32}},
+            **augmentation_parameters,
         },
     )
     dataset_name = "data-is-better-together/imgsys-results-prompts-style_v2_part1"
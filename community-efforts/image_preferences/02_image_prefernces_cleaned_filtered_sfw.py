@@ -1,116 +1,218 @@
-from collections import defaultdict
+from typing import Dict, List, Tuple
 
-from datasets import load_dataset
-from transformers import pipeline
+import numpy as np
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from datasets import Dataset, Image, load_dataset
+from huggingface_hub import HfApi
 
-pipe_text = pipeline(
-    "text-classification",
-    model="ezb/NSFW-Prompt-Detector",
-    device="mps",
-)
-pipe_text_2 = pipeline(
-    "text-classification",
-    model="michellejieli/NSFW_text_classifier",
-    device="mps",
-)
-pipe_image = pipeline(
-    "image-classification",
-    model="MichalMlodawski/nsfw-image-detection-large",
-    device="mps",
-)
+from nsfw_scoring import ImageClassifier, TextClassifier, is_flagged, resolve_device
 
-label_to_category_text = {
-    "LABEL_0": "Safe",
-    "LABEL_1": "Questionable",
-    "LABEL_2": "Unsafe",
-}
-
-
-def clean_dataset(batch):
-    try:
-        batch["nsfw_text"] = []
-        batch["nsfw_image"] = []
-        evaluated_results_image = defaultdict(list)
-        evaluated_results_text = defaultdict(list)
-
-        image_columns = [
-            "image_quality_dev",
-            "image_simplified_dev",
-            "image_quality_sd",
-            "image_simplified_sd",
-        ]
-
-        for image_column in image_columns:
-            results_image = pipe_image(batch[image_column])
-            evaluated_results_image[image_column] = [
-                res[0]["label"] in ["UNSAFE", "QUESTIONABLE"] for res in results_image
-            ]
-
-        try:
-            results_text = pipe_text(batch["prompt"])
-            results_text_2 = pipe_text_2(batch["prompt"])
-            evaluated_results_text["text"] = [
-                res["label"] == "NSFW" for res in results_text
-            ]
-            evaluated_results_text["text_2"] = [
-                res["label"] == "NSFW" for res in results_text_2
-            ]
-        except Exception:
-            try:
-                results_text_2 = pipe_text_2(batch["prompt"])
-                evaluated_results_text["text_2"] = [
-                    res["label"] == "NSFW" for res in results_text_2
-                ]
-                evaluated_results_text["text"] = [False] * len(results_text_2)
-            except Exception:
-                try:
-                    results_text = pipe_text(batch["prompt"])
-                    evaluated_results_text["text"] = [
-                        res["label"] == "NSFW" for res in results_text
-                    ]
-                    evaluated_results_text["text_2"] = [False] * len(results_text)
-                except Exception:
-                    for item in batch["prompt"]:
-                        try:
-                            evaluated_results_text["text"].append(
-                                pipe_text(item)["label"] == "NSFW"
-                            )
-                        except Exception:
-                            evaluated_results_text["text"].append(True)
-                        try:
-                            evaluated_results_text["text_2"].append(
-                                pipe_text_2(item)["label"] == "NSFW"
-                            )
-                        except Exception:
-                            evaluated_results_text["text_2"].append(True)
-
-        for i in range(len(evaluated_results_text["text"])):
-            if any(evaluated_results_text[col][i] for col in evaluated_results_text):
-                batch["nsfw_text"].append(True)
-            else:
-                batch["nsfw_text"].append(False)
-        for i in range(len(evaluated_results_image["image_quality_dev"])):
-            if any(evaluated_results_image[col][i] for col in evaluated_results_image):
-                batch["nsfw_image"].append(True)
-            else:
-                batch["nsfw_image"].append(False)
-    except Exception as e:
-        raise Exception(e)
-    return batch
-
-
-ds = load_dataset(
-    "data-is-better-together/open-image-preferences-v1-unfiltered", split="train"
-)
-df = ds.filter(
-    lambda x: x["image_quality_dev"]
-    and x["image_simplified_dev"]
-    and x["image_quality_sd"]
-    and x["image_simplified_sd"]
+SOURCE_REPO_ID = "data-is-better-together/open-image-preferences-v1-unfiltered"
+# Revision of the source dataset, defaults to the latest one, or with `REFILTER` to the one
+# the scores were computed on, and is recorded in the metadata of `SCORES_PATH`
+SOURCE_REVISION = None
+# Device the classifiers run on, e.g. "cuda", "mps" or "cpu", defaults to the first one
+# available
+DEVICE = None
+BATCH_SIZE = 256  # number of rows scored at once, up to 4 times more images
+IMAGE_BATCH_SIZE = 32  # number of images per forward pass of the image classifier
+# Number of threads decoding the images while the image classifier runs, defaults to
+# the number of cores
+NUM_DECODE_THREADS = None
+IMAGE_COLUMNS = [
+    "image_quality_dev",
+    "image_simplified_dev",
+    "image_quality_sd",
+    "image_simplified_sd",
+]
+TEXT_MODELS = ["ezb/NSFW-Prompt-Detector", "michellejieli/NSFW_text_classifier"]
+TEXT_BATCH_SIZE = 64  # number of prompts per forward pass of the text classifiers
+NSFW_TEXT_LABEL = "NSFW"
+NSFW_IMAGE_LABELS = ["UNSAFE", "QUESTIONABLE"]
+# Probability of `NSFW_TEXT_LABEL`, and summed probability of `NSFW_IMAGE_LABELS`, from
+# which a prompt or an image is NSFW, defaults to it being the most likely label
+TEXT_THRESHOLD = None
+IMAGE_THRESHOLD = None
+# Only score the rows no previous text classifier flagged, with the next text classifiers
+# and the images, as they are dropped anyway. Their other scores are then missing, so run once without it to tune all the thresholds, as
+# the scores of a run with it cannot be filtered again with `REFILTER`.
+CASCADE = True
+# Parquet file the scores of every classifier are written to, by `row_id`, the index of
+# the row in the `SOURCE_REVISION` of the unfiltered dataset
+SCORES_PATH = "nsfw_scores.parquet"
+# Filter the dataset with the scores of `SCORES_PATH` and the thresholds above, without
+# running the classifiers again, which needs the scores of a run without `CASCADE`
+REFILTER = False
+
+
+def text_classifier_name(model: str) -> str:
+    return model.split("/")[-1]
+
+
+def classifier_scores(
+    columns: Dict[str, np.ndarray], name: str
+) -> Tuple[np.ndarray, List[str]]:
+    """Returns the scores of a classifier, stored in the `<name>/<label>` columns, and their
+    labels."""
+    labels = [
+        column.split("/", 1)[1] for column in columns if column.startswith(f"{name}/")
+    ]
+    scores = np.stack(
+        [np.asarray(columns[f"{name}/{label}"], dtype=np.float32) for label in labels],
+        axis=1,
+    )
+    return scores, labels
+
+
+def is_text_flagged(scores: np.ndarray, labels: List[str]) -> np.ndarray:
+    return is_flagged(scores, labels, [NSFW_TEXT_LABEL], TEXT_THRESHOLD)
+
+
+def is_image_flagged(scores: np.ndarray, labels: List[str]) -> np.ndarray:
+    return is_flagged(scores, labels, NSFW_IMAGE_LABELS, IMAGE_THRESHOLD)
+
+
+def nsfw_flags(columns: Dict[str, np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns whether the prompt and whether any image of each row is NSFW, from the
+    scores of all the classifiers."""
+    num_rows = len(columns["row_id"])
+    nsfw_text = np.zeros(num_rows, dtype=bool)
+    for model in TEXT_MODELS:
+        nsfw_text |= is_text_flagged(
+            *classifier_scores(columns, text_classifier_name(model))
+        )
+    nsfw_image = np.zeros(num_rows, dtype=bool)
+    for column in IMAGE_COLUMNS:
+        nsfw_image |= is_image_flagged(*classifier_scores(columns, column))
+    return nsfw_text, nsfw_image
+
+
+def rows_with_images(dataset: Dataset, columns: List[str]) -> np.ndarray:
+    """Returns the indices of the rows with an image in all the `columns`, from the bytes
+    and paths stored in the Arrow table, without decoding any image."""
+    present = np.ones(len(dataset), dtype=bool)
+    for column in columns:
+        images = dataset.data.column(column)
+        has_image = pc.and_(
+            pc.is_valid(images),
+            pc.or_(
+                pc.is_valid(pc.struct_field(images, "bytes")),
+                pc.is_valid(pc.struct_field(images, "path")),
+            ),
+        )
+        present &= has_image.to_numpy(zero_copy_only=False)
+    return np.flatnonzero(present)
+
+
+def score_dataset(batch, indices):
+    ## With `CASCADE`, the rows flagged by a text classifier are not scored by the next
+    ## classifiers, the image one running last, and their other scores are NaN
+    prompts = batch["prompt"]
+    flagged = np.zeros(len(prompts), dtype=bool)
+    scores_batch = {"row_id": row_ids[indices]}
+
+    def store(classifier, name, rows, rows_scores, is_classifier_flagged):
+        scores = np.full((len(prompts), len(classifier.labels)), np.nan, np.float32)
+        scores[rows] = rows_scores
+        for label, label_scores in zip(classifier.labels, scores.T):
+            scores_batch[f"{name}/{label}"] = label_scores
+        return is_classifier_flagged(scores, classifier.labels)
+
+    def rows_to_score():
+        return np.flatnonzero(~flagged) if CASCADE else np.arange(len(prompts))
+
+    for model, text_classifier in zip(TEXT_MODELS, text_classifiers):
+        rows = rows_to_score()
+        text_scores = text_classifier.score([prompts[i] for i in rows])
+        name = text_classifier_name(model)
+        flagged |= store(text_classifier, name, rows, text_scores, is_text_flagged)
+    ## The images of all the columns of the rows left are scored in a single call, so the
+    ## image classifier runs on full batches and keeps decoding ahead across the columns
+    rows = rows_to_score()
+    images = [batch[column][i] for column in IMAGE_COLUMNS for i in rows]
+    image_scores = image_classifier.score(images)
+    image_scores = image_scores.reshape(
+        len(IMAGE_COLUMNS), len(rows), len(image_classifier.labels)
+    )
+    for column, column_scores in zip(IMAGE_COLUMNS, image_scores):
+        store(image_classifier, column, rows, column_scores, is_image_flagged)
+    return scores_batch
+
+
+## The scores are by row index, so they are only valid for the revision of the source
+## dataset they were computed on
+if REFILTER:
+    scores_metadata = pq.read_schema(SCORES_PATH).metadata
+    ## The rows a cascaded run did not fully score have NaN scores, which are flagged
+    ## whatever the thresholds
+    if scores_metadata.get(b"cascade", b"true") == b"true":
+        raise ValueError(
+            f"The scores of '{SCORES_PATH}' were computed with `CASCADE`, so the rows"
+            " flagged by a classifier were not scored by the next ones, run it again with"
+            " `CASCADE = False` and `REFILTER = False` to score all the rows."
+        )
+    scores_revision = scores_metadata[b"source_revision"].decode()
+    if SOURCE_REVISION and SOURCE_REVISION != scores_revision:
+        raise ValueError(
+            f"The scores of '{SCORES_PATH}' were computed on the revision {scores_revision}"
+            f" of '{SOURCE_REPO_ID}', not {SOURCE_REVISION}, run it again with"
+            " `REFILTER = False` to score this revision."
+        )
+    source_revision = scores_revision
+else:
+    source_revision = (
+        SOURCE_REVISION or HfApi().dataset_info(SOURCE_REPO_ID).sha  # type: ignore
+    )
+ds = load_dataset(SOURCE_REPO_ID, split="train", revision=source_revision)
+if not REFILTER:
+    device = resolve_device(DEVICE)
+    text_classifiers = [
+        TextClassifier(model, device=device, batch_size=TEXT_BATCH_SIZE)
+        for model in TEXT_MODELS
+    ]
+    image_classifier = ImageClassifier(
+        "MichalMlodawski/nsfw-image-detection-large",
+        device=device,
+        batch_size=IMAGE_BATCH_SIZE,
+        num_threads=NUM_DECODE_THREADS,
+    )
+
+    ## The rows missing an image are skipped from the Arrow table, and the other ones
+    ## are read once, by a single pass decoding their images on the threads of the image
+    ## classifier and only writing their scores, the images of the rows kept being only
+    ## written once, when pushed
+    row_ids = rows_with_images(ds, IMAGE_COLUMNS)
+    df = ds.select(row_ids)
+    for column in IMAGE_COLUMNS:
+        df = df.cast_column(column, Image(decode=False))
+    scores = df.map(
+        score_dataset,
+        with_indices=True,
+        batched=True,
+        batch_size=BATCH_SIZE,
+        remove_columns=df.column_names,
+    )
+    image_classifier.close()
+    table = scores.data.table
+    pq.write_table(
+        table.replace_schema_metadata(
+            {
+                **(table.schema.metadata or {}),
+                "source_revision": source_revision,
+                "cascade": str(CASCADE).lower(),
+            }
+        ),
+        SCORES_PATH,
+    )
+
+## The raw scores are kept, so the dataset can be filtered again with other thresholds
+## with `REFILTER`, without running the classifiers
+scores = pq.read_table(SCORES_PATH)
+nsfw_text, nsfw_image = nsfw_flags(
+    {name: scores[name].to_numpy() for name in scores.column_names}
 )
-ds = df.map(clean_dataset, batched=True, batch_size=100)
-ds = ds.filter(lambda x: not x["nsfw_text"] and not x["nsfw_image"])
-ds = ds.remove_columns(["nsfw_text", "nsfw_image"])
+ds = ds.select(scores["row_id"].to_numpy()[~(nsfw_text | nsfw_image)])
 ds.push_to_hub(
     "data-is-better-together/open-image-preferences-v1",
     split="cleaned",
@@ -0,0 +1,125 @@
+"""AIMD concurrency limiter, to send as many requests to an endpoint as it can serve."""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import numpy as np
+
+OVERLOADED_STATUS_CODES = {429, 502, 503, 504}
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """Returns the HTTP status code of an error raised by the `huggingface_hub` client."""
+    response = getattr(error, "response", None)
+    return getattr(error, "status", None) or getattr(response, "status_code", None)
+
+
+def is_connection_error(error: BaseException) -> bool:
+    """Returns whether a request failed without a response, timed out or disconnected."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    # the connection errors of aiohttp, without depending on it
+    return any(cls.__name__ == "ClientConnectionError" for cls in type(error).__mro__)
+
+
+def is_overload(error: BaseException) -> bool:
+    """Returns whether a failed request means the endpoint cannot take more requests: it
+    was rate limited, its gateway gave up on it, or it timed out or was dropped."""
+    return is_connection_error(error) or status_code(error) in OVERLOADED_STATUS_CODES
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits the number of requests in flight with additive increase, multiplicative
+    decrease (AIMD), like TCP congestion control.
+
+    Each request succeeding with a latency below `latency_tolerance` times the median of the
+    last `window` ones increases the limit by `1 / limit`, i.e. by one after a full limit of
+    requests, while a latency spike or a request failing with an overload (a 429, 502, 503
+    or 504 status, a timeout or a connection error) divides it by `backoff`. The other
+    failures, e.g. an invalid request, leave the limit and the latencies as they are. Only
+    the requests started after the last decrease can decrease it again, so a burst of
+    failures caused by the same overload only backs off once.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        backoff: float = 2.0,
+        latency_tolerance: float = 2.0,
+        window: int = 100,
+    ) -> None:
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._last_decrease = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """Returns the `q`-th percentile of the latency of the last requests, in seconds."""
+        return float(np.percentile(self._latencies, q)) if self._latencies else None
+
+    def stats(self) -> Dict[str, Optional[float]]:
+        return {
+            "limit": self.limit,
+            "in_flight": self._in_flight,
+            "p50": self.latency_percentile(50),
+            "p95": self.latency_percentile(95),
+        }
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Waits until there are less than `limit` requests in flight and holds a slot for
+        the request sent in the `async with` block, adjusting the limit when it ends."""
+        if self._condition is None:
+            # created lazily so it is bound to the event loop running the requests
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            if is_overload(e):
+                self._decrease(start)
+            raise
+        else:
+            latency = time.monotonic() - start
+            if self._is_latency_spike(latency):
+                self._decrease(start)
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._latencies.append(latency)
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._condition.notify_all()
+
+    def _is_latency_spike(self, latency: float) -> bool:
+        if len(self._latencies) < min(10, self._latencies.maxlen):
+            return False
+        return latency > self.latency_tolerance * self.latency_percentile(50)
+
+    def _decrease(self, start: float) -> None:
+        if start < self._last_decrease:
+            return
+        self._limit = max(self.min_limit, self._limit / self.backoff)
+        self._last_decrease = time.monotonic()
@@ -0,0 +1,216 @@
+"""Style categories and subcategories used to augment the prompts, shared by the synthetic data generation scripts."""
+
+## Let's determine the categories and subcategories for the image generation task
+# https://huggingface.co/spaces/google/sdxl/blob/main/app.py#L55
+categories = {
+    # included
+    "Cinematic": [
+        # included
+        "emotional",
+        "harmonious",
+        "vignette",
+        "highly detailed",
+        "high budget",
+        "bokeh",
+        "cinemascope",
+        "moody",
+        "epic",
+        "gorgeous",
+        "film grain",
+        "grainy",
+    ],
+    # included
+    "Photographic": [
+        # included
+        "film",
+        "bokeh",
+        "professional",
+        "4k",
+        "highly detailed",
+        ## not included
+        "Landscape",
+        "Portrait",
+        "Macro",
+        "Portra",
+        "Gold",
+        "ColorPlus",
+        "Ektar",
+        "Superia",
+        "C200",
+        "CineStill",
+        "CineStill 50D",
+        "CineStill 800T",
+        "Tri-X",
+        "HP5",
+        "Delta",
+        "T-Max",
+        "Fomapan",
+        "StreetPan",
+        "Provia",
+        "Ektachrome",
+        "Velvia",
+    ],
+    # included
+    "Anime": [
+        # included
+        "anime style",
+        "key visual",
+        "vibrant",
+        "studio anime",
+        "highly detailed",
+    ],
+    # included
+    "Manga": [
+        # included
+        "vibrant",
+        "high-energy",
+        "detailed",
+        "iconic",
+        "Japanese comic style",
+    ],
+    # included
+    "Digital art": [
+        # included
+        "digital artwork",
+        "illustrative",
+        "painterly",
+        "matte painting",
+        "highly detailed",
+    ],
+    # included
+    "Pixel art": [
+        # included
+        "low-res",
+        "blocky",
+        "pixel art style",
+        "8-bit graphics",
+    ],
+    # included
+    "Fantasy art": [
+        # included
+        "magnificent",
+        "celestial",
+        "ethereal",
+        "painterly",
+        "epic",
+        "majestic",
+        "magical",
+        "fantasy art",
+        "cover art",
+        "dreamy",
+    ],
+    # included
+    "Neonpunk": [
+        # included
+        "cyberpunk",
+        "vaporwave",
+        "neon",
+        "vibes",
+        "vibrant",
+        "stunningly beautiful",
+        "crisp",
+        "detailed",
+        "sleek",
+        "ultramodern",
+        "magenta highlights",
+        "dark purple shadows",
+        "high contrast",
+        "cinematic",
+        "ultra detailed",
+        "intricate",
+        "professional",
+    ],
+    # included
+    "3D Model": [
+        # included
+        "octane render",
+        "highly detailed",
+        "volumetric",
+        "dramatic lighting",
+    ],
+    # not included
+    "Painting": [
+        "Oil",
+        "Acrylic",
+        "Watercolor",
+        "Digital",
+        "Mural",
+        "Sketch",
+        "Gouache",
+        "Renaissance",
+        "Baroque",
+        "Romanticism",
+        "Impressionism",
+        "Expressionism",
+        "Cubism",
+        "Surrealism",
+        "Pop Art",
+        "Minimalism",
+        "Realism",
+        "Encaustic",
+        "Tempera",
+        "Fresco",
+        "Ink Wash",
+        "Spray Paint",
+        "Mixed Media",
+    ],
+    # not included
+    "Animation": [
+        # not included
+        "Animation",
+        "Stop motion",
+        "Claymation",
+        "Pixel Art",
+        "Vector",
+        "Hand-drawn",
+        "Cutout",
+        "Whiteboard",
+    ],
+    # not included
+    "Illustration": [
+        # not included
+        "Book",
+        "Comics",
+        "Editorial",
+        "Advertising",
+        "Technical",
+        "Fantasy",
+        "Scientific",
+        "Fashion",
+        "Storyboard",
+        "Concept Art",
+        "Manga",
+        "Anime",
+        "Digital",
+        "Vector",
+        "Design",
+    ],
+}
+
+## Categories and subcategories marked as "not included" above, which are never sampled
+excluded_categories = [
+    "Painting",
+    "Animation",
+    "Illustration",
+    ["Photographic", "Landscape"],
+    ["Photographic", "Portrait"],
+    ["Photographic", "Macro"],
+    ["Photographic", "Portra"],
+    ["Photographic", "Gold"],
+    ["Photographic", "ColorPlus"],
+    ["Photographic", "Ektar"],
+    ["Photographic", "Superia"],
+    ["Photographic", "C200"],
+    ["Photographic", "CineStill"],
+    ["Photographic", "CineStill 50D"],
+    ["Photographic", "CineStill 800T"],
+    ["Photographic", "Tri-X"],
+    ["Photographic", "HP5"],
+    ["Photographic", "Delta"],
+    ["Photographic", "T-Max"],
+    ["Photographic", "Fomapan"],
+    ["Photographic", "StreetPan"],
+    ["Photographic", "Provia"],
+    ["Photographic", "Ektachrome"],
+    ["Photographic", "Velvia"],
+]
@@ -0,0 +1,105 @@
+import hashlib
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from distilabel.mixins.runtime_parameters import RuntimeParameter
+from distilabel.steps import Step, StepInput
+from distilabel.steps.typing import StepOutput
+from pydantic import Field, PrivateAttr
+
+
+def flatten_categories(
+    categories: Dict[str, List[str]],
+    category_weights: Optional[Dict[str, float]] = None,
+    excluded: Optional[List[Union[str, List[str]]]] = None,
+) -> Tuple[List[str], List[str], np.ndarray]:
+    """Flattens the categories into `(category, subcategory)` pairs and the probability of
+    sampling each of them.
+
+    A category is sampled with a probability proportional to its weight (1 by default) and
+    then one of its subcategories uniformly. `excluded` contains either category names, to
+    exclude all their subcategories, or `[category, subcategory]` pairs.
+    """
+    category_weights = category_weights or {}
+    excluded_categories = {entry for entry in excluded or [] if isinstance(entry, str)}
+    excluded_pairs = {
+        tuple(entry) for entry in excluded or [] if not isinstance(entry, str)
+    }
+
+    flat_categories, flat_subcategories, weights = [], [], []
+    for category, subcategories in categories.items():
+        if category in excluded_categories:
+            continue
+        subcategories = [
+            subcategory
+            for subcategory in subcategories
+            if (category, subcategory) not in excluded_pairs
+        ]
+        for subcategory in subcategories:
+            flat_categories.append(category)
+            flat_subcategories.append(subcategory)
+            weights.append(category_weights.get(category, 1.0) / len(subcategories))
+
+    weights = np.array(weights, dtype=np.float64)
+    return flat_categories, flat_subcategories, weights / weights.sum()
+
+
+class CategorySelector(Step):
+    """Assigns a style `category` and `subcategory` to each prompt.
+
+    The `(category, subcategory)` table is flattened once when the step is loaded, and the
+    pair of each prompt is drawn from a uniform value derived from the hash of `seed` and
+    the prompt, all the pairs of a batch being looked up at once in the cumulative
+    probabilities. A prompt is then assigned the same category whatever the batch it is
+    in, so reruns keep the cache of the following steps valid.
+    """
+
+    categories: Dict[str, List[str]]
+    category_weights: Optional[Dict[str, float]] = None
+    excluded: List[Union[str, List[str]]] = Field(default_factory=list)
+    seed: RuntimeParameter[int] = Field(
+        default=42,
+        description="The seed used to sample the category of each prompt.",
+    )
+
+    _categories: Optional[np.ndarray] = PrivateAttr(default=None)
+    _subcategories: Optional[np.ndarray] = PrivateAttr(default=None)
+    _cumulative_probabilities: Optional[np.ndarray] = PrivateAttr(default=None)
+
+    @property
+    def inputs(self) -> List[str]:
+        return ["prompt"]
+
+    @property
+    def outputs(self) -> List[str]:
+        return ["category", "subcategory"]
+
+    def load(self) -> None:
+        super().load()
+        categories, subcategories, probabilities = flatten_categories(
+            self.categories, self.category_weights, self.excluded
+        )
+        self._cumulative_probabilities = np.cumsum(probabilities)
+        self._categories = np.array(categories, dtype=object)
+        self._subcategories = np.array(subcategories, dtype=object)
+
+    def process(self, inputs: StepInput) -> "StepOutput":  # type: ignore
+        digests = [
+            hashlib.blake2b(f"{self.seed}:{input['prompt']}".encode(), digest_size=8)
+            for input in inputs
+        ]
+        # the 53 high bits of each digest, as a uniform value in [0, 1)
+        uniforms = np.array(
+            [int.from_bytes(digest.digest(), "little") >> 11 for digest in digests],
+            dtype=np.float64,
+        ) / float(1 << 53)
+        choices = np.minimum(
+            np.searchsorted(self._cumulative_probabilities, uniforms, side="right"),
+            len(self._cumulative_probabilities) - 1,
+        )
+        for input, category, subcategory in zip(
+            inputs, self._categories[choices], self._subcategories[choices]
+        ):
+            input["category"] = category
+            input["subcategory"] = subcategory
+        yield inputs
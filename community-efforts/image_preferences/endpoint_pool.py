@@ -0,0 +1,138 @@
+"""Routing of the requests of a model to a pool of endpoints serving it, by least
+outstanding requests, dropping the endpoints that keep failing."""
+
+import asyncio
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from adaptive_concurrency import (
+    AdaptiveConcurrencyLimiter,
+    is_connection_error,
+    status_code,
+)
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Returns whether a failed request means the endpoint is unavailable: connection and
+    server errors, but not a rate limit or an invalid request."""
+    return is_connection_error(error) or (status_code(error) or 0) >= 500
+
+
+class Replica:
+    """An endpoint of the pool, with its own concurrency limit."""
+
+    def __init__(self, url: str, limiter: AdaptiveConcurrencyLimiter) -> None:
+        self.url = url
+        self.limiter = limiter
+        self.outstanding = 0
+        self.num_requests = 0
+        self.num_failures = 0
+        self.consecutive_failures = 0
+        self.num_ejections = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def load(self) -> float:
+        """The requests sent to the endpoint relative to its concurrency limit."""
+        return self.outstanding / self.limiter.limit
+
+    def is_healthy(self, now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.monotonic()
+        return now >= self.unhealthy_until
+
+
+class EndpointPool:
+    """Sends each request to the healthy replica with the least outstanding requests
+    relative to its concurrency limit, so a slow or small endpoint gets less requests than
+    a fast or large one, and ties are broken randomly. The requests wait in the pool until
+    a replica is below its limit, instead of in the queue of the replica they were sent to,
+    so they always go to the best replica at the time they are sent.
+
+    A replica failing `max_failures` requests in a row is dropped for `cooldown` seconds,
+    doubled every time it is dropped again up to `max_cooldown`, after which it gets
+    requests again and is back for good after its first success. If all the replicas are
+    dropped, the requests are sent to the one coming back the soonest.
+    """
+
+    def __init__(
+        self,
+        replicas: List[Replica],
+        max_failures: int = 3,
+        cooldown: float = 30.0,
+        max_cooldown: float = 600.0,
+    ) -> None:
+        if not replicas:
+            raise ValueError("An endpoint pool needs at least one replica")
+        self.replicas = replicas
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._condition: Optional[asyncio.Condition] = None
+
+    def choose(self) -> Optional[Replica]:
+        """Returns the replica the next request should be sent to, or `None` if all the
+        replicas it could be sent to are at their concurrency limit."""
+        now = time.monotonic()
+        candidates = [replica for replica in self.replicas if replica.is_healthy(now)]
+        if not candidates:
+            candidates = [
+                min(self.replicas, key=lambda replica: replica.unhealthy_until)
+            ]
+        candidates = [replica for replica in candidates if replica.load < 1]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda replica: (replica.load, random.random()))
+
+    @asynccontextmanager
+    async def request(self) -> AsyncIterator[Replica]:
+        """Waits for a replica below its concurrency limit and holds a slot of it for the
+        request sent to it in the `async with` block, recording whether it succeeded."""
+        if self._condition is None:
+            # created lazily so it is bound to the event loop running the requests
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            replica = await self._condition.wait_for(self.choose)
+            replica.outstanding += 1
+
+        try:
+            async with replica.limiter.slot():
+                replica.num_requests += 1
+                try:
+                    yield replica
+                except Exception as e:
+                    if is_endpoint_failure(e):
+                        self._record_failure(replica)
+                    raise
+                replica.consecutive_failures = 0
+                replica.num_ejections = 0
+        finally:
+            async with self._condition:
+                replica.outstanding -= 1
+                self._condition.notify_all()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        return [
+            {
+                "url": replica.url,
+                "healthy": replica.is_healthy(now),
+                "requests": replica.num_requests,
+                "failures": replica.num_failures,
+                **replica.limiter.stats(),
+            }
+            for replica in self.replicas
+        ]
+
+    def _record_failure(self, replica: Replica) -> None:
+        replica.num_failures += 1
+        replica.consecutive_failures += 1
+        # the requests in flight when the replica is dropped do not drop it again
+        if replica.consecutive_failures >= self.max_failures and replica.is_healthy():
+            cooldown = self.cooldown * 2**replica.num_ejections
+            replica.unhealthy_until = time.monotonic() + min(
+                cooldown, self.max_cooldown
+            )
+            replica.num_ejections += 1
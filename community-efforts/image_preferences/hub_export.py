@@ -0,0 +1,340 @@
+"""Streaming export of the generated image preferences to the Hugging Face Hub."""
+
+import hashlib
+import json
+import os
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from datasets import Features, Image
+from distilabel.mixins.runtime_parameters import RuntimeParameter
+from distilabel.steps import Step, StepInput
+from distilabel.steps.typing import StepOutput
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete, HfApi
+from pydantic import Field, PrivateAttr, SecretStr
+
+from image_store import ImageStore
+
+
+class PushImagesToHub(Step):
+    """Uploads the rows it receives to a dataset repository of the Hub as they are
+    generated, in parquet shards of `shard_size` rows with the images embedded.
+
+    The exported columns are the `image_columns`, as `Image` features, and the columns of
+    `features`, a `Features.to_dict()` declaring the type of the other columns, so all the
+    shards share the same schema even when a column is null in all the rows of a shard.
+
+    The rows of a shard only keep the path of their images in the `ImageStore` until the
+    shard is full, then the images are read and written `row_group_size` rows at a time, so
+    at most one row group of images is held in memory. Each shard is uploaded in the
+    background while the pipeline keeps generating, and the uploaded shards are committed
+    `shards_per_commit` at a time, to stay below the commit rate limit of the Hub.
+    When the step is unloaded the remaining rows are flushed and a last commit writes the
+    dataset card, with the features and the `train` split of the shards, and deletes the
+    shards of the repository that are not part of this export. The rows are passed through
+    unchanged.
+
+    The export can be resumed, as distilabel does not send again the batches a step already
+    received: the state of the export is kept in `<image_store_path>/hub_export/<repo>`, a
+    manifest of the shards written so far and their features, the rows received since the
+    last shard, and the keys of all the rows received, so the rows sent again are skipped.
+    A shard is kept there until it is committed, so the ones not committed before a crash
+    are uploaded when the step is loaded again. `finish` does the same and commits the card
+    from the main process, for the runs whose steps were all cached and so never loaded.
+    """
+
+    repo_id: str
+    image_columns: List[str]
+    features: Dict[str, Any] = Field(default_factory=dict)
+    image_store_path: str = "image_store"
+    private: bool = False
+    script_path: Optional[str] = None
+    shard_size: RuntimeParameter[int] = Field(
+        default=100,
+        description="The number of rows of each parquet shard uploaded to the Hub.",
+    )
+    shards_per_commit: RuntimeParameter[int] = Field(
+        default=10,
+        description="The number of shards uploaded to the Hub in each commit.",
+    )
+    row_group_size: RuntimeParameter[int] = Field(
+        default=32,
+        description="The number of rows whose images are read and written at once.",
+    )
+    token: Optional[RuntimeParameter[SecretStr]] = Field(
+        default_factory=lambda: os.getenv("HF_TOKEN"),
+        description="The token used to push to the Hub.",
+    )
+
+    _api: Optional[HfApi] = PrivateAttr(default=None)
+    _image_store: Optional[ImageStore] = PrivateAttr(default=None)
+    _state_dir: Optional[Path] = PrivateAttr(default=None)
+    _rows: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _received: Set[str] = PrivateAttr(default_factory=set)
+    _features: Optional[Features] = PrivateAttr(default=None)
+    _uploads: List[Future] = PrivateAttr(default_factory=list)
+    _uncommitted: List[CommitOperationAdd] = PrivateAttr(default_factory=list)
+    _shards: List[Dict[str, Any]] = PrivateAttr(default_factory=list)
+    _loaded: bool = PrivateAttr(default=False)
+
+    @property
+    def inputs(self) -> List[str]:
+        return [*self.features, *self.image_columns]
+
+    @property
+    def outputs(self) -> List[str]:
+        return []
+
+    def load(self) -> None:
+        super().load()
+        token = self.token.get_secret_value() if self.token else None
+        self._api = HfApi(token=token)
+        self._api.create_repo(
+            self.repo_id, repo_type="dataset", private=self.private, exist_ok=True
+        )
+        self._image_store = ImageStore(self.image_store_path, writer=self.name)
+        self._state_dir = (
+            Path(self.image_store_path) / "hub_export" / self.repo_id.replace("/", "--")
+        )
+        (self._state_dir / "data").mkdir(parents=True, exist_ok=True)
+
+        manifest_path = self._state_dir / "manifest.json"
+        manifest = (
+            json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+        )
+        self._features = Features(
+            {
+                **Features.from_dict(self.features),
+                **{name: Image() for name in self.image_columns},
+            }
+        )
+        if manifest and manifest["features"] != self._features.to_dict():
+            raise ValueError(
+                f"The features of the export to '{self.repo_id}' changed since the"
+                f" previous run, remove '{self._state_dir}' and the shards of the"
+                " repository to export it again."
+            )
+        self._shards = manifest.get("shards", [])
+        self._rows = self._read_rows(self._pending_path())
+        keys_path = self._state_dir / "received_keys.txt"
+        self._received = (
+            set(keys_path.read_text().split()) if keys_path.exists() else set()
+        )
+        self._received.update(_row_key(row) for row in self._rows)
+        self._uploads, self._uncommitted = [], []
+        ## The shards written by a previous run but not committed before it stopped
+        for shard in self._shards:
+            if (self._state_dir / shard["path"]).exists():
+                self._upload(shard["path"])
+        self._loaded = True
+
+    def unload(self) -> None:
+        super().unload()
+        # also called when `load` failed, which must not commit an empty export
+        if not self._loaded:
+            return
+        self._loaded = False
+        if self._rows:
+            self._write_shard(len(self._rows))
+        if self._uncommitted:
+            self._commit_shards()
+        for upload in self._uploads:
+            upload.result()
+        if self._shards:
+            self._commit_card()
+
+    def finish(self) -> None:
+        """Uploads the shards and rows left by the previous runs and commits the dataset
+        card, to be called once the pipeline has run."""
+        self.load()
+        self.unload()
+
+    def process(self, inputs: StepInput) -> "StepOutput":  # type: ignore
+        rows = [dict(input) for input in inputs]
+        rows = [row for row in rows if _row_key(row) not in self._received]
+        if rows:
+            ## The rows are persisted before being acknowledged to distilabel, which
+            ## will not send them again
+            with open(self._pending_path(), "a") as pending:
+                pending.writelines(json.dumps(row) + "\n" for row in rows)
+                pending.flush()
+                os.fsync(pending.fileno())
+            keys = [_row_key(row) for row in rows]
+            with open(self._state_dir / "received_keys.txt", "a") as received_keys:
+                received_keys.writelines(key + "\n" for key in keys)
+            self._received.update(keys)
+            self._rows.extend(rows)
+        while len(self._rows) >= self.shard_size:
+            self._write_shard(self.shard_size)
+        yield inputs
+
+    def _pending_path(self) -> Path:
+        return self._state_dir / f"pending-{len(self._shards):05d}.jsonl"
+
+    @staticmethod
+    def _read_rows(path: Path) -> List[Dict[str, Any]]:
+        if not path.exists():
+            return []
+        rows = []
+        with open(path) as lines:
+            for line in lines:
+                try:
+                    rows.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line of a run interrupted while appending
+                    continue
+        return rows
+
+    def _write_shard(self, num_rows: int) -> None:
+        """Writes the first `num_rows` rows to the next shard, records it in the manifest
+        and moves the other rows to the pending rows of the shard after it, before the
+        upload of the shard starts."""
+        rows, self._rows = self._rows[:num_rows], self._rows[num_rows:]
+        previous_pending_path = self._pending_path()
+        path_in_repo = f"data/train-{len(self._shards):05d}.parquet"
+        local_path = self._state_dir / path_in_repo
+        temporary_path = local_path.with_name(f".{local_path.name}.tmp")
+
+        writer = None
+        for start in range(0, len(rows), self.row_group_size):
+            table = self._embed_images(rows[start : start + self.row_group_size])
+            if writer is None:
+                writer = pq.ParquetWriter(temporary_path, table.schema)
+            writer.write_table(table)
+        writer.close()
+        os.replace(temporary_path, local_path)
+
+        self._shards.append({"path": path_in_repo, "num_rows": len(rows)})
+        self._write_state("manifest.json", json.dumps(self._manifest(), indent=2))
+        self._write_state(
+            self._pending_path().name,
+            "".join(json.dumps(row) + "\n" for row in self._rows),
+        )
+        previous_pending_path.unlink(missing_ok=True)
+        self._upload(path_in_repo)
+        self._logger.info(
+            f"Uploading '{path_in_repo}' with {len(rows)} rows to '{self.repo_id}'"
+        )
+        if len(self._uncommitted) >= self.shards_per_commit:
+            self._commit_shards()
+
+    def _upload(self, path_in_repo: str) -> None:
+        """Uploads a shard in the background, without committing it yet."""
+        operation = CommitOperationAdd(
+            path_in_repo=path_in_repo,
+            path_or_fileobj=str(self._state_dir / path_in_repo),
+        )
+        self._uploads.append(
+            self._api.run_as_future(
+                self._api.preupload_lfs_files,
+                self.repo_id,
+                additions=[operation],
+                repo_type="dataset",
+            )
+        )
+        self._uncommitted.append(operation)
+
+    def _commit_shards(self) -> None:
+        """Commits the uploaded shards in the background, after their uploads as the
+        background tasks of the `HfApi` run one at a time, in order."""
+        operations, self._uncommitted = self._uncommitted, []
+        commit = self._api.create_commit(
+            repo_id=self.repo_id,
+            repo_type="dataset",
+            operations=operations,
+            commit_message="Upload "
+            + ", ".join(operation.path_in_repo for operation in operations),
+            run_as_future=True,
+        )
+
+        # a shard is only removed once committed, so a failed one is uploaded on resume
+        def remove_shards(commit: Future) -> None:
+            if commit.exception() is None:
+                for operation in operations:
+                    Path(operation.path_or_fileobj).unlink(missing_ok=True)
+
+        commit.add_done_callback(remove_shards)
+        self._uploads.append(commit)
+
+    def _manifest(self) -> Dict[str, Any]:
+        return {
+            "repo_id": self.repo_id,
+            "shards": self._shards,
+            "features": self._features.to_dict(),
+        }
+
+    def _write_state(self, name: str, content: str) -> None:
+        path = self._state_dir / name
+        temporary_path = path.with_name(f".{name}.tmp")
+        with open(temporary_path, "w") as state:
+            state.write(content)
+            state.flush()
+            os.fsync(state.fileno())
+        os.replace(temporary_path, path)
+
+    def _embed_images(self, rows: List[Dict[str, Any]]) -> pa.Table:
+        """Returns the rows as a table of the declared features, with the encoded images in
+        their `Image` columns."""
+        columns = {name: [row.get(name) for row in rows] for name in self._features}
+        for name in self.image_columns:
+            paths = [
+                image["path"].removeprefix("artifacts/") if image else None
+                for image in columns[name]
+            ]
+            columns[name] = [
+                {"bytes": image, "path": None} if image else None
+                for image in self._image_store.read_many(paths)
+            ]
+        return pa.Table.from_pydict(columns, schema=self._features.arrow_schema)
+
+    def _commit_card(self) -> None:
+        """Writes the dataset card, and the script if any, and deletes the shards that are
+        not in the manifest, e.g. left by an export to the same repository that was not
+        resumed."""
+        card_data = {
+            "configs": [
+                {
+                    "config_name": "default",
+                    "data_files": [{"split": "train", "path": "data/train-*"}],
+                }
+            ],
+        }
+        num_rows = sum(shard["num_rows"] for shard in self._shards)
+        card_data["dataset_info"] = {
+            "features": self._features._to_yaml_list(),
+            "splits": [{"name": "train", "num_examples": num_rows}],
+        }
+        card = f"---\n{yaml.safe_dump(card_data, sort_keys=False)}---\n"
+
+        operations = [
+            CommitOperationAdd(path_in_repo="README.md", path_or_fileobj=card.encode())
+        ]
+        if self.script_path:
+            operations.append(
+                CommitOperationAdd(
+                    path_in_repo=Path(self.script_path).name,
+                    path_or_fileobj=self.script_path,
+                )
+            )
+        shard_paths = {shard["path"] for shard in self._shards}
+        operations.extend(
+            CommitOperationDelete(path_in_repo=path)
+            for path in self._api.list_repo_files(self.repo_id, repo_type="dataset")
+            if path.startswith("data/train-") and path not in shard_paths
+        )
+        self._api.create_commit(
+            repo_id=self.repo_id,
+            repo_type="dataset",
+            operations=operations,
+            commit_message=f"Upload the dataset card of {num_rows} rows",
+        )
+
+
+def _row_key(row: Dict[str, Any]) -> str:
+    """Returns a key identifying a row, to skip the rows received again."""
+    content = json.dumps(row, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
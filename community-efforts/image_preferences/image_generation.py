@@ -0,0 +1,449 @@
+"""Image generation with Inference Endpoints, passing the encoded images returned by the
+endpoint through as raw bytes."""
+
+import asyncio
+import hashlib
+import random
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Union
+
+import aiohttp
+import stamina
+from distilabel.constants import DISTILABEL_METADATA_KEY
+from distilabel.llms import InferenceEndpointsLLM
+from distilabel.mixins.runtime_parameters import RuntimeParameter
+from distilabel.steps.base import StepInput
+from distilabel.steps.tasks import Task
+from distilabel.steps.typing import StepOutput
+from huggingface_hub.utils import build_hf_headers
+from PIL import Image
+from pydantic import (
+    Field,
+    PositiveFloat,
+    PositiveInt,
+    PrivateAttr,
+    model_validator,
+    validate_call,
+)
+
+from adaptive_concurrency import (
+    AdaptiveConcurrencyLimiter,
+    is_connection_error,
+    status_code,
+)
+from endpoint_pool import EndpointPool, Replica
+from image_store import ImageStore
+
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# status codes of an endpoint refusing a given prompt or its parameters, unlike e.g. a 401,
+# 403 or 404 that fail every request of the run
+REJECTED_STATUS_CODES = {400, 413, 422}
+# seeds are kept below 2**31 as some diffusion servers store them in a signed 32-bit int
+_MAX_SEED = 2**31 - 1
+
+
+def image_seed(prompt: str, step_name: str, generation: int, seed: int) -> int:
+    """Derives the seed of an image from the prompt, the step generating it, the index of the
+    generation and a global seed, so the same image can be generated again."""
+    key = f"{seed}\n{step_name}\n{generation}\n{prompt}".encode()
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return int.from_bytes(digest, "little") % _MAX_SEED
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """Returns whether a failed request is worth retrying: timeouts, connection errors and
+    the status codes returned by an overloaded or scaling endpoint."""
+    return is_connection_error(error) or status_code(error) in RETRYABLE_STATUS_CODES
+
+
+def is_rejected_request(error: BaseException) -> bool:
+    """Returns whether the endpoint rejected the request itself, e.g. its prompt, as
+    invalid, too large or unprocessable."""
+    return status_code(error) in REJECTED_STATUS_CODES
+
+
+def decode_image(data: Union[bytes, memoryview]) -> Image.Image:
+    """Decodes an encoded image, only needed when its pixels are used."""
+    return Image.open(BytesIO(data))
+
+
+## At the time of writing this, the distilabel library does not support the image generation endpoint.
+## This is a temporary fix to allow us to use the image generation endpoint.
+
+
+class InferenceEndpointsImageLLM(InferenceEndpointsLLM):
+    """Generates images with the text-to-image task of an Inference Endpoint.
+
+    The image is returned as the encoded bytes sent by the endpoint instead of being decoded
+    with `text_to_image`, so it can be written as is without re-encoding it. The request is
+    sent with `aiohttp` rather than the `post` method of the `AsyncInferenceClient`, which
+    was removed from `huggingface_hub`.
+
+    The requests in flight are bounded by an `AdaptiveConcurrencyLimiter`, which starts at
+    `initial_concurrency` and grows up to `max_concurrency` while the latency is stable, and
+    backs off when the endpoint is overloaded, so the step uses all the replicas of the
+    endpoint without hand-tuning its `input_batch_size`, which only needs to be larger than
+    the concurrency the endpoint can take.
+
+    `base_urls` spreads the requests over several endpoints serving the same model, each
+    with its own limiter, routing them with an `EndpointPool` to the one with the least
+    outstanding requests and dropping for a while the ones failing `max_failures` requests
+    in a row, so capacity is added by deploying another endpoint and adding its URL.
+
+    Each request is retried on its own on transient errors, up to `max_attempts` times with
+    an exponential jittered backoff and within `retry_deadline` seconds, each attempt being
+    cancelled after `request_timeout` seconds. A request failing after all its attempts, or
+    whose prompt is rejected by the endpoint with a 400, 413 or 422 status, returns no
+    image instead of failing the whole batch, while any other error, e.g. an invalid token
+    or endpoint URL, is raised.
+
+    The image is generated with the `seed` of the input, or a random one if it has none.
+    """
+
+    base_urls: Optional[List[str]] = Field(
+        default=None,
+        description="The URLs of the endpoints serving the model, the first one being"
+        " used as `base_url` if it is not given.",
+    )
+    max_failures: RuntimeParameter[PositiveInt] = Field(
+        default=3,
+        description="The number of requests failing in a row after which an endpoint"
+        " of `base_urls` stops receiving requests for a while.",
+    )
+    unhealthy_cooldown: RuntimeParameter[PositiveFloat] = Field(
+        default=30,
+        description="The number of seconds a failing endpoint stops receiving requests"
+        " for, doubled every time it fails again.",
+    )
+
+    initial_concurrency: RuntimeParameter[PositiveInt] = Field(
+        default=4,
+        description="The number of requests sent concurrently to each endpoint at"
+        " start.",
+    )
+    max_concurrency: RuntimeParameter[PositiveInt] = Field(
+        default=64,
+        description="The maximum number of requests sent concurrently to each endpoint.",
+    )
+
+    max_attempts: RuntimeParameter[PositiveInt] = Field(
+        default=5,
+        description="The maximum number of attempts to generate an image.",
+    )
+    request_timeout: RuntimeParameter[PositiveFloat] = Field(
+        default=300,
+        description="The number of seconds after which an attempt is cancelled.",
+    )
+    retry_deadline: RuntimeParameter[PositiveFloat] = Field(
+        default=900,
+        description="The number of seconds after which a failed image is not retried.",
+    )
+    retry_wait_initial: RuntimeParameter[PositiveFloat] = Field(
+        default=2,
+        description="The number of seconds to wait before the first retry, doubled, with"
+        " jitter, for every following one.",
+    )
+    retry_wait_max: RuntimeParameter[PositiveFloat] = Field(
+        default=60,
+        description="The maximum number of seconds to wait between two attempts.",
+    )
+
+    _pool: Optional[EndpointPool] = PrivateAttr(default=None)
+    _session: Optional[aiohttp.ClientSession] = PrivateAttr(default=None)
+
+    @model_validator(mode="before")
+    @classmethod
+    def default_base_url_to_first_of_base_urls(cls, data: Any) -> Any:
+        if isinstance(data, dict) and data.get("base_urls"):
+            if not any(
+                data.get(name) for name in ("base_url", "model_id", "endpoint_name")
+            ):
+                data = {**data, "base_url": data["base_urls"][0]}
+        return data
+
+    def load(self) -> None:
+        super().load()
+        replicas = []
+        for url in dict.fromkeys([self.base_url, *(self.base_urls or [])]):
+            limiter = AdaptiveConcurrencyLimiter(
+                initial_limit=self.initial_concurrency, max_limit=self.max_concurrency
+            )
+            replicas.append(Replica(url, limiter))
+        self._pool = EndpointPool(
+            replicas, max_failures=self.max_failures, cooldown=self.unhealthy_cooldown
+        )
+
+    def unload(self) -> None:
+        if self._session is not None:
+            self.event_loop.run_until_complete(self._session.close())
+            self._session = None
+        super().unload()
+
+    def generate(
+        self, inputs: List[Any], num_generations: int = 1, **kwargs: Any
+    ) -> List[Any]:
+        outputs = super().generate(
+            inputs=inputs, num_generations=num_generations, **kwargs
+        )
+        for stats in self._pool.stats():
+            if stats["p50"] is None:
+                continue
+            self._logger.info(
+                f"Endpoint {stats['url']}: {'healthy' if stats['healthy'] else 'dropped'},"
+                f" {stats['requests']} requests, {stats['failures']} failed,"
+                f" concurrency limit: {stats['limit']}, latency p50: {stats['p50']:.1f}s,"
+                f" p95: {stats['p95']:.1f}s"
+            )
+        return outputs
+
+    @validate_call
+    async def agenerate(
+        self,
+        input: Dict[str, Any],
+        negative_prompt: Optional[str] = None,
+        height: Optional[float] = None,
+        width: Optional[float] = None,
+        num_inference_steps: Optional[float] = None,
+        guidance_scale: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        parameters = {
+            "negative_prompt": negative_prompt,
+            "height": int(height) if height else None,
+            "width": int(width) if width else None,
+            "num_inference_steps": int(num_inference_steps)
+            if num_inference_steps
+            else None,
+            "guidance_scale": float(guidance_scale) if guidance_scale else None,
+            "seed": input["seed"]
+            if input.get("seed") is not None
+            else random.randint(0, 1000000),
+        }
+        num_attempts = 0
+        try:
+            async for attempt in stamina.retry_context(
+                on=is_transient_error,
+                attempts=self.max_attempts,
+                timeout=self.retry_deadline,
+                wait_initial=self.retry_wait_initial,
+                wait_max=self.retry_wait_max,
+            ):
+                with attempt:
+                    num_attempts = attempt.num
+                    image = await self._post_image(input.get("prompt"), parameters)
+        except Exception as e:
+            ## Only the failures of the endpoint, or its rejection of this prompt, cost
+            ## the image of a single prompt, any other error is a bug failing the step
+            if not (is_transient_error(e) or is_rejected_request(e)):
+                raise
+            self._logger.warning(
+                f"Failed to generate an image after {num_attempts} attempts: {e}"
+            )
+            image = None
+        return [{"image": image, "seed": parameters["seed"], "attempts": num_attempts}]
+
+    async def _post_image(self, prompt: str, parameters: Dict[str, Any]) -> bytes:
+        if self._session is None:
+            # created lazily so it is bound to the event loop running the requests
+            self._session = aiohttp.ClientSession(
+                headers={
+                    **build_hf_headers(token=self.api_key.get_secret_value()),
+                    "Accept": "image/png",
+                }
+            )
+        payload = {
+            "inputs": prompt,
+            "parameters": {
+                name: value for name, value in parameters.items() if value is not None
+            },
+        }
+        async with self._pool.request() as replica:
+            return await asyncio.wait_for(
+                self._request_image(replica.url, payload),
+                timeout=self.request_timeout,
+            )
+
+    async def _request_image(self, url: str, payload: Dict[str, Any]) -> bytes:
+        """Sends the text-to-image request to the endpoint and returns the encoded image,
+        raising an `aiohttp.ClientResponseError`, with its `status`, on an HTTP error."""
+        async with self._session.post(url, json=payload) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+class ImageGeneration(Task):
+    """Generates an image per prompt and writes the bytes returned by the endpoint to the
+    `ImageStore` at `image_store_path`, shared by all the image generation steps.
+
+    The `image` column contains the path of the image relative to the directory the store is
+    uploaded to, `artifacts/blobs/<ab>/<cd>/<sha256>.<format>`.
+
+    The seed of each image is derived from the prompt, the name of the step, the index of the
+    generation and `seed` with `image_seed`, and is returned in the `seed` column, so any
+    image can be generated again.
+
+    With `resume`, the prompts whose images were already generated with the same model, seed
+    and generation kwargs, e.g. before a crash or by a run with a different pipeline cache,
+    are not sent to the endpoint and their stored images are used instead.
+    """
+
+    # the raw output is the encoded image, which does not belong in the dataset
+    add_raw_output: RuntimeParameter[bool] = Field(
+        default=False,
+        description="Whether to include the raw output of the LLM in the key"
+        " `raw_output_<TASK_NAME>` of the `distilabel_metadata` dictionary.",
+    )
+    image_store_path: RuntimeParameter[str] = Field(
+        default="image_store",
+        description="The directory of the store the generated images are written to.",
+    )
+    seed: RuntimeParameter[int] = Field(
+        default=42,
+        description="The global seed the seed of each image is derived from.",
+    )
+    resume: RuntimeParameter[bool] = Field(
+        default=True,
+        description="Whether to reuse the images already in the store instead of"
+        " generating them again.",
+    )
+
+    _image_store: Optional[ImageStore] = PrivateAttr(default=None)
+
+    def load(self) -> None:
+        super().load()
+        self._image_store = ImageStore(self.image_store_path, writer=self.name)
+
+    @property
+    def inputs(self) -> List[str]:
+        return ["prompt"]
+
+    @property
+    def outputs(self) -> List[str]:
+        return ["image", "seed", "model_name"]
+
+    def format_input(self, input: Dict[str, Any]) -> Dict[str, str]:
+        return {"prompt": input["prompt"]}
+
+    def format_output(
+        self, output: Dict[str, Any], input: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        return {
+            "image": output.get("image"),
+            "seed": output.get("seed"),
+            "attempts": output.get("attempts"),
+            "model_name": self.llm.model_name,
+        }
+
+    def process(self, *args: StepInput) -> "StepOutput":
+        inputs = args[0] if args else []
+        stored_records = [self._stored_records(input) for input in inputs]
+        missing = [i for i, records in enumerate(stored_records) if records is None]
+        if len(missing) < len(inputs):
+            self._logger.info(
+                f"Reusing the stored images of {len(inputs) - len(missing)} of"
+                f" {len(inputs)} prompts"
+            )
+
+        ## Each generation is a request of its own, so each gets its own seed
+        requests = [
+            (i, generation)
+            for i in missing
+            for generation in range(self.num_generations)
+        ]
+        generated_outputs = []
+        if requests:
+            generated_outputs = self.llm.generate_outputs(
+                inputs=[
+                    {
+                        **self.format_input(inputs[i]),
+                        "seed": self._image_seed(inputs[i], generation),
+                    }
+                    for i, generation in requests
+                ],
+                num_generations=1,
+                **self.llm.get_generation_kwargs(),
+            )
+        outputs = {i: [] for i in missing}
+        for (i, _), output in zip(requests, generated_outputs):
+            outputs[i].extend(output)
+
+        task_outputs, stored_outputs, images = [], [], []
+        for i, input in enumerate(inputs):
+            if stored_records[i] is not None:
+                for record in stored_records[i]:
+                    formatted_output = self._maybe_add_raw_input_output(
+                        {
+                            "image": {"path": f"artifacts/{record['path']}"},
+                            "seed": record["seed"],
+                            "model_name": self.llm.model_name,
+                        },
+                        None,
+                        input,
+                        add_raw_output=self.add_raw_output,  # type: ignore
+                        add_raw_input=self.add_raw_input,  # type: ignore
+                    )
+                    self._add_num_attempts(formatted_output, 0)
+                    task_outputs.append({**input, **formatted_output})
+                continue
+
+            formatted_outputs = self._format_outputs(outputs[i], input)
+            for generation, formatted_output in enumerate(formatted_outputs):
+                image = formatted_output.pop("image", None)
+                self._add_num_attempts(
+                    formatted_output, formatted_output.pop("attempts", None)
+                )
+                task_output = {
+                    **input,
+                    **formatted_output,
+                    "image": None,
+                    "seed": self._image_seed(input, generation),
+                    "model_name": self.llm.model_name,
+                }
+                task_outputs.append(task_output)
+                if image:
+                    stored_outputs.append(task_output)
+                    images.append((image, self._image_metadata(input, generation)))
+
+        ## The images of the whole batch are written, and fsynced, at once
+        records = self._image_store.put_many(images)
+        for task_output, record in zip(stored_outputs, records):
+            task_output["image"] = {"path": f"artifacts/{record['path']}"}
+        yield task_outputs
+
+    def _add_num_attempts(
+        self, formatted_output: Dict[str, Any], num_attempts: Optional[int]
+    ) -> None:
+        """Records the number of requests sent for the image, 0 if it was already stored."""
+        metadata = formatted_output.setdefault(DISTILABEL_METADATA_KEY, {})
+        metadata[f"num_attempts_{self.name}"] = num_attempts
+
+    def _image_seed(self, input: Dict[str, Any], generation: int) -> int:
+        return image_seed(input["prompt"], self.name, generation, self.seed)
+
+    def _request_key(self, input: Dict[str, Any], generation: int) -> str:
+        return ImageStore.request_key(
+            self.llm.model_name,
+            input["prompt"],
+            generation=generation,
+            seed=self._image_seed(input, generation),
+            **self.llm.get_generation_kwargs(),
+        )
+
+    def _stored_records(self, input: Dict[str, Any]) -> Optional[List[Dict[str, Any]]]:
+        """Returns the stored records of all the generations of the input, or `None` if
+        `resume` is disabled or any of them is missing."""
+        if not self.resume:
+            return None
+        records = [
+            self._image_store.lookup(self._request_key(input, generation))
+            for generation in range(self.num_generations)
+        ]
+        return None if None in records else records
+
+    def _image_metadata(self, input: Dict[str, Any], generation: int) -> Dict[str, Any]:
+        return {
+            "key": self._request_key(input, generation),
+            "model": self.llm.model_name,
+            "prompt": input["prompt"],
+            "seed": self._image_seed(input, generation),
+            "step": self.name,
+        }
@@ -0,0 +1,149 @@
+"""Content-addressed on-disk store of the generated images."""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+_IMAGE_SIGNATURES = {
+    b"\xff\xd8\xff": "jpeg",
+    b"\x89PNG\r\n\x1a\n": "png",
+    b"GIF8": "gif",
+    b"RIFF": "webp",
+}
+
+
+def image_format(data: Union[bytes, memoryview]) -> str:
+    """Returns the format of an encoded image from its magic bytes, without decoding it."""
+    header = bytes(data[:8])
+    for signature, format in _IMAGE_SIGNATURES.items():
+        if header.startswith(signature):
+            return format
+    raise ValueError(f"Unknown image format with header {header!r}")
+
+
+class ImageStore:
+    """Stores encoded images under `<root>/blobs/<ab>/<cd>/<sha256>.<format>`, so identical
+    images are only written once and different images never overwrite each other, and keeps
+    an index of the `(model, prompt, seed)` each image was generated from, looked up by the
+    `request_key` of the model, prompt and generation parameters.
+
+    Every writer, e.g. a step of the pipeline running in its own process, appends to its own
+    `<root>/index/<writer>.jsonl` so writers never interleave their records, and readers
+    merge all of them. The images of a batch are all written to temporary files before any
+    of them is fsynced, so the kernel can flush them together, then renamed, and only then
+    their records are appended to the index, fsynced once, so the index never points to an
+    incomplete blob.
+    """
+
+    def __init__(self, root: Union[str, Path], writer: str = "default") -> None:
+        self.root = Path(root)
+        self.writer = writer
+        self.index_dir = self.root / "index"
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+
+    @staticmethod
+    def request_key(
+        model: str, prompt: str, generation: int = 0, **parameters: Any
+    ) -> str:
+        """Returns the key of the `generation`-th image generated by `model` for `prompt`
+        with the given generation parameters."""
+        request = {
+            "model": model,
+            "prompt": prompt,
+            "generation": generation,
+            "parameters": parameters,
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def blob_path(sha256: str, format: str) -> Path:
+        """Returns the path of a blob relative to the root of the store."""
+        return Path("blobs") / sha256[:2] / sha256[2:4] / f"{sha256}.{format}"
+
+    def put_many(
+        self, items: List[Tuple[Union[bytes, memoryview], Dict[str, Any]]]
+    ) -> List[Dict[str, Any]]:
+        """Stores a batch of `(image, metadata)` pairs, where the metadata contains at least
+        the request `key`, `model` and `prompt`, and returns the index record of each image."""
+        records, pending = [], []
+        for image, metadata in items:
+            sha256 = hashlib.sha256(image).hexdigest()
+            path = self.blob_path(sha256, image_format(image))
+            records.append({**metadata, "sha256": sha256, "path": path.as_posix()})
+            if not (self.root / path).exists() and path not in pending:
+                pending.append(path)
+                self._write_temporary(self.root / path, image)
+
+        for path in pending:
+            self._fsync(self._temporary(self.root / path))
+        for path in pending:
+            os.replace(self._temporary(self.root / path), self.root / path)
+        for directory in {(self.root / path).parent for path in pending}:
+            self._fsync(directory)
+
+        if records:
+            with open(self.index_dir / f"{self.writer}.jsonl", "a") as index:
+                index.writelines(json.dumps(record) + "\n" for record in records)
+                index.flush()
+                os.fsync(index.fileno())
+            if self._index is not None:
+                for record in records:
+                    self._index[record["key"]] = record
+        return records
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns the latest record stored for a request key, if any and its image is still
+        on disk."""
+        if self._index is None:
+            self._index = self._load_index()
+        record = self._index.get(key)
+        if record is None or not (self.root / record["path"]).exists():
+            return None
+        return record
+
+    def read_many(
+        self, paths: List[Optional[str]], max_workers: int = 16
+    ) -> List[Optional[bytes]]:
+        """Reads the encoded images at the given paths, relative to the root of the store,
+        with a pool of threads as reading files releases the GIL, and `None` for the `None`
+        paths."""
+
+        def read(path: Optional[str]) -> Optional[bytes]:
+            return (self.root / path).read_bytes() if path else None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(read, paths))
+
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        index = {}
+        for index_file in sorted(self.index_dir.glob("*.jsonl")):
+            with open(index_file) as records:
+                for line in records:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line of a writer interrupted while appending
+                        continue
+                    index[record["key"]] = record
+        return index
+
+    @staticmethod
+    def _temporary(path: Path) -> Path:
+        return path.with_name(f".{path.name}.{os.getpid()}.tmp")
+
+    def _write_temporary(self, path: Path, image: Union[bytes, memoryview]) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self._temporary(path), "wb") as blob:
+            blob.write(image)
+
+    @staticmethod
+    def _fsync(path: Path) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
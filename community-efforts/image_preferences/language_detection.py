@@ -0,0 +1,105 @@
+# Canonical copy, copied as is to the folders below so each of them runs on its own,
+# copy the changes made here to them:
+#   cookbook-efforts/dpo-orpo-preference/language_detection.py
+"""Batched language detection with fast-langdetect, or another fastText language
+identification model, spread over a pool of processes."""
+
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import fasttext
+import pyarrow as pa
+from fast_langdetect import detect
+
+# the fastText models loaded by each process, by path
+_models: Dict[str, Any] = {}
+
+
+def _detect(text: str, model_path: Optional[str]) -> Tuple[str, float]:
+    text = text.replace("\n", " ")
+    if model_path is None:
+        result = detect(text)
+        if isinstance(result, list):  # newer fast-langdetect versions return the top-k
+            result = result[0]
+        return result["lang"], float(result["score"])
+    if model_path not in _models:
+        _models[model_path] = fasttext.load_model(model_path)
+    labels, scores = _models[model_path].predict(text, k=1)
+    return labels[0].removeprefix("__label__"), float(scores[0])
+
+
+def _detect_chunk(
+    texts: List[str], model_path: Optional[str] = None
+) -> Tuple[List[str], List[float]]:
+    # loads the model outside of the handling of the texts, as a model that cannot be
+    # loaded is not a text that cannot be detected
+    _detect("language", model_path)
+    languages, scores = [], []
+    for text in texts:
+        try:
+            language, score = _detect(text, model_path)
+        except Exception:
+            # a text that cannot be detected does not fail the rest of the chunk
+            language, score = "error", 0.0
+        languages.append(language)
+        scores.append(score)
+    return languages, scores
+
+
+class LanguageDetector:
+    """Detects the language of batches of texts, splitting each batch in chunks that are
+    processed by a pool of `num_proc` processes, each loading the fastText model once.
+
+    The languages are the ISO 639-1 codes predicted by fast-langdetect, or the labels of the
+    fastText model at `model_path` if given, e.g. `nld_Latn` for OpenLID. The texts that
+    cannot be detected get the "error" language and a score of 0.
+
+    The detection runs in the current process when `num_proc` is 1 or when called from a
+    daemonic process (e.g. a distilabel step), as those cannot start child processes.
+    """
+
+    def __init__(
+        self,
+        num_proc: Optional[int] = None,
+        max_chunk_size: int = 10_000,
+        model_path: Optional[str] = None,
+    ):
+        self.num_proc = num_proc or os.cpu_count() or 1
+        self.max_chunk_size = max_chunk_size
+        self.model_path = model_path
+        self._executor = None
+        if self.num_proc > 1 and not multiprocessing.current_process().daemon:
+            self._executor = ProcessPoolExecutor(max_workers=self.num_proc)
+
+    def detect(self, texts: List[str]) -> Tuple[pa.Array, pa.Array]:
+        """Returns the language and the score predicted for each text as Arrow arrays."""
+        chunk_size = max(
+            1, min(self.max_chunk_size, math.ceil(len(texts) / self.num_proc))
+        )
+        chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+        detect_chunk = partial(_detect_chunk, model_path=self.model_path)
+        if self._executor is not None:
+            results = self._executor.map(detect_chunk, chunks)
+        else:
+            results = map(detect_chunk, chunks)
+
+        languages, scores = [], []
+        for chunk_languages, chunk_scores in results:
+            languages.extend(chunk_languages)
+            scores.extend(chunk_scores)
+        return pa.array(languages, pa.string()), pa.array(scores, pa.float32())
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> "LanguageDetector":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any, List
+
+from distilabel.llms import InferenceEndpointsLLM
+from distilabel.mixins.runtime_parameters import RuntimeParameter
+from distilabel.steps.tasks.typing import FormattedInput
+from pydantic import Field, PositiveInt
+
+from response_cache import CachedInferenceEndpointsLLM
+
+
+class ConcurrentInferenceEndpointsLLM(InferenceEndpointsLLM):
+    """`InferenceEndpointsLLM` that caps the number of requests in flight per step.
+
+    distilabel sends every row of a batch to the endpoint at once and waits for the whole
+    batch before sending the next one, so with small batches the endpoint idles while the
+    slowest request of each batch finishes, and with large ones a single step can flood it.
+    With this LLM steps can use large `input_batch_size`s while `max_concurrent_requests`
+    bounds how many of their requests the endpoint serves at a time. As each step runs in
+    its own process with its own client, the load on an endpoint shared by several steps
+    is the sum of their `max_concurrent_requests`.
+    """
+
+    max_concurrent_requests: RuntimeParameter[PositiveInt] = Field(
+        default=16,
+        description="The maximum number of requests sent concurrently to the endpoint.",
+    )
+
+    async def _agenerate(
+        self, inputs: List[FormattedInput], num_generations: int = 1, **kwargs: Any
+    ) -> List[List[Any]]:
+        semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        async def bounded_agenerate(input: FormattedInput) -> List[Any]:
+            async with semaphore:
+                return await self.agenerate(input=input, **kwargs)
+
+        outputs = await asyncio.gather(
+            *[
+                bounded_agenerate(input)
+                for input in inputs
+                for _ in range(num_generations)
+            ]
+        )
+        return [
+            [output[0] for output in outputs[i : i + num_generations]]
+            for i in range(0, len(outputs), num_generations)
+        ]
+
+
+class CachedConcurrentInferenceEndpointsLLM(
+    CachedInferenceEndpointsLLM, ConcurrentInferenceEndpointsLLM
+):
+    """`ConcurrentInferenceEndpointsLLM` that only sends the requests missing from its
+    response cache, see `ResponseCacheMixin`."""
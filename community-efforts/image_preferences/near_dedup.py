@@ -0,0 +1,124 @@
+"""Near-duplicate prompt detection with MinHash signatures and LSH banding."""
+
+import re
+import zlib
+from pathlib import Path
+from typing import List, Set, Tuple, Union
+
+import numpy as np
+
+from prompt_cleaning import FingerprintSet, normalize_prompt
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize_for_shingling(prompt: str) -> str:
+    """Normalizes the prompt and removes its punctuation."""
+    return " ".join(_PUNCTUATION.sub(" ", normalize_prompt(prompt)).split())
+
+
+def shingle(prompt: str, ngram_size: int = 2) -> Set[str]:
+    """Returns the word n-grams of the normalized prompt, or the whole normalized prompt
+    if it has fewer than `ngram_size` words."""
+    words = normalize_for_shingling(prompt).split()
+    if len(words) < ngram_size:
+        return {" ".join(words)}
+    return {
+        " ".join(words[i : i + ngram_size]) for i in range(len(words) - ngram_size + 1)
+    }
+
+
+def lsh_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """Returns the number of bands and rows per band whose S-curve threshold,
+    `(1 / bands) ** (1 / rows)`, is the closest to the given Jaccard `threshold`."""
+    return min(
+        ((num_perm // rows, rows) for rows in range(1, num_perm + 1)),
+        key=lambda bands_rows: abs(
+            (1 / bands_rows[0]) ** (1 / bands_rows[1]) - threshold
+        ),
+    )
+
+
+class MinHashLSH:
+    """Flags prompts whose estimated Jaccard similarity with a previously added prompt is
+    above `threshold`.
+
+    Signatures are computed for a whole batch at once with NumPy, and for each LSH band only
+    a 64-bit key per prompt is kept (in a `FingerprintSet`), so neither the prompts nor their
+    signatures stay in memory. As usual with LSH deduplication, candidates sharing a band are
+    treated as duplicates without verifying their similarity.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        ngram_size: int = 2,
+        seed: int = 42,
+        chunk_size: int = 2048,
+    ) -> None:
+        self.threshold = threshold
+        self.ngram_size = ngram_size
+        self.chunk_size = chunk_size
+        self.num_bands, self.rows_per_band = lsh_bands(threshold, num_perm)
+        self.num_perm = self.num_bands * self.rows_per_band
+
+        # `a * x + b` fits in 64 bits as both the coefficients and the hashes are 32-bit
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 32, size=self.num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 32, size=self.num_perm, dtype=np.uint64)
+        self._bands = [FingerprintSet() for _ in range(self.num_bands)]
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Saves the band keys of the prompts added so far to a `.npz` file."""
+        np.savez(path, *[band_keys.fingerprints for band_keys in self._bands])
+
+    def load(self, path: Union[str, Path]) -> None:
+        """Loads the band keys saved with `save`, which must use the same parameters."""
+        with np.load(path) as saved_bands:
+            if len(saved_bands.files) != self.num_bands:
+                raise ValueError(
+                    f"'{path}' has {len(saved_bands.files)} LSH bands but {self.num_bands}"
+                    " are expected, it was saved with different parameters."
+                )
+            self._bands = [
+                FingerprintSet(saved_bands[name]) for name in saved_bands.files
+            ]
+
+    def signatures(self, prompts: List[str]) -> np.ndarray:
+        """Returns the `(len(prompts), num_perm)` MinHash signatures of the prompts."""
+        signatures = np.empty((len(prompts), self.num_perm), dtype=np.uint32)
+        for start in range(0, len(prompts), self.chunk_size):
+            chunk = prompts[start : start + self.chunk_size]
+            hashes = [
+                np.fromiter(
+                    {zlib.crc32(s.encode()) for s in shingle(prompt, self.ngram_size)},
+                    dtype=np.uint64,
+                )
+                for prompt in chunk
+            ]
+            offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+            permuted = np.concatenate(hashes)[:, None] * self._a + self._b
+            # fast `% (2**61 - 1)` for a Mersenne prime, avoiding a 64-bit division
+            permuted = ((permuted & _MERSENNE_PRIME) + (permuted >> 61)) & _MAX_HASH
+            signatures[start : start + len(chunk)] = np.minimum.reduceat(
+                permuted, offsets, axis=0
+            )
+        return signatures
+
+    def add(self, prompts: List[str]) -> np.ndarray:
+        """Adds a batch of prompts and returns a boolean mask with the ones that are not
+        near-duplicates of any prompt added before them."""
+        signatures = self.signatures(prompts).astype(np.uint64)
+        is_unique = np.ones(len(prompts), dtype=bool)
+        for band, band_keys in enumerate(self._bands):
+            rows = signatures[
+                :, band * self.rows_per_band : (band + 1) * self.rows_per_band
+            ]
+            keys = np.zeros(len(prompts), dtype=np.uint64)
+            for column in rows.T:
+                keys = keys * np.uint64(0x100000001B3) ^ column
+            is_unique &= band_keys.add(keys)
+        return is_unique
@@ -0,0 +1,202 @@
+"""Batched NSFW scoring of the prompts and generated images, decoding the images on a pool
+of threads while the classifier runs."""
+
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from PIL import Image
+from transformers import (
+    AutoImageProcessor,
+    AutoModelForImageClassification,
+    pipeline,
+)
+
+
+def resolve_device(device: Optional[str] = None) -> str:
+    """Returns `device`, or the first available of "cuda", "mps" and "cpu" if it is `None`."""
+    if device is not None:
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def load_image(image: Union[bytes, Dict[str, Any], Image.Image]) -> Image.Image:
+    """Decodes an image given as bytes or as the `{"bytes", "path"}` dict of an undecoded
+    `datasets.Image` column."""
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    if isinstance(image, dict):
+        image = image["bytes"] if image.get("bytes") else image["path"]
+    if isinstance(image, str):
+        return Image.open(image).convert("RGB")
+    return Image.open(BytesIO(image)).convert("RGB")
+
+
+def is_flagged(
+    scores: np.ndarray,
+    labels: List[str],
+    flagged_labels: List[str],
+    threshold: Optional[float] = None,
+) -> np.ndarray:
+    """Returns whether each row of `scores` is flagged: its most likely label is one of
+    `flagged_labels` or, with a `threshold`, the summed probability of `flagged_labels` is
+    at least `threshold`. The rows that could not be scored, with NaN scores, are flagged."""
+    columns = [labels.index(label) for label in flagged_labels if label in labels]
+    if threshold is None:
+        flagged = np.isin(scores.argmax(axis=1), columns)
+    else:
+        flagged = scores[:, columns].sum(axis=1) >= threshold
+    return flagged | np.isnan(scores).any(axis=1)
+
+
+def _top_labels(scores: np.ndarray, labels: List[str]) -> List[Optional[str]]:
+    return [
+        None if np.isnan(row).any() else labels[int(row.argmax())] for row in scores
+    ]
+
+
+class TextClassifier:
+    """Scores texts with a text classification model in batches of `batch_size`.
+
+    The texts are truncated to `max_length` tokens, by default the maximum length of the
+    model, so long prompts do not fail. A batch failing anyway is split in halves, which are
+    scored again, until the texts that fail are isolated, so a bad text only costs a few
+    extra calls and the other ones are still scored in batches. The texts that cannot be
+    scored, or are not strings, get NaN scores.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        device: Optional[str] = None,
+        batch_size: int = 64,
+        max_length: Optional[int] = None,
+    ) -> None:
+        self.device = resolve_device(device)
+        self.batch_size = batch_size
+        self.pipeline = pipeline("text-classification", model=model, device=self.device)
+        config = self.pipeline.model.config
+        self.labels = [config.id2label[i] for i in range(config.num_labels)]
+        self.max_length = max_length or min(
+            self.pipeline.tokenizer.model_max_length,
+            getattr(config, "max_position_embeddings", 512),
+        )
+        self.num_failures = 0
+
+    def score(self, texts: List[Optional[str]]) -> np.ndarray:
+        """Returns the probability of each label for each text, as a `(len(texts),
+        len(labels))` array."""
+        scores = np.full((len(texts), len(self.labels)), np.nan, dtype=np.float32)
+        valid = [i for i, text in enumerate(texts) if isinstance(text, str)]
+        self.num_failures += len(texts) - len(valid)
+        for start in range(0, len(valid), self.batch_size):
+            indices = valid[start : start + self.batch_size]
+            self._score_batch(indices, [texts[i] for i in indices], scores)
+        return scores
+
+    def top_labels(self, scores: np.ndarray) -> List[Optional[str]]:
+        """Returns the most likely label of each text, `None` for the unscored ones."""
+        return _top_labels(scores, self.labels)
+
+    def _score_batch(
+        self, indices: List[int], texts: List[str], scores: np.ndarray
+    ) -> None:
+        try:
+            outputs = self.pipeline(
+                texts,
+                batch_size=len(texts),
+                truncation=True,
+                max_length=self.max_length,
+                top_k=None,
+            )
+        except Exception:
+            if len(texts) == 1:
+                self.num_failures += 1
+                return
+            middle = len(texts) // 2
+            self._score_batch(indices[:middle], texts[:middle], scores)
+            self._score_batch(indices[middle:], texts[middle:], scores)
+            return
+        for i, output in zip(indices, outputs):
+            for label_score in output:
+                scores[i, self.labels.index(label_score["label"])] = label_score[
+                    "score"
+                ]
+
+
+class ImageClassifier:
+    """Scores images with an image classification model in batches of `batch_size`.
+
+    The images are decoded and preprocessed into tensors by a pool of `num_threads` threads,
+    as decoding releases the GIL, up to `num_threads` batches ahead of the one the model is
+    running on, so the model does not wait for the images of the next batch. All the images
+    to score, e.g. the four images of each row of a dataset batch, are given in a single
+    call so the model runs on full batches.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        device: Optional[str] = None,
+        batch_size: int = 32,
+        num_threads: Optional[int] = None,
+    ) -> None:
+        self.device = resolve_device(device)
+        self.batch_size = batch_size
+        self.processor = AutoImageProcessor.from_pretrained(model)
+        self.model = AutoModelForImageClassification.from_pretrained(model)
+        self.model.to(self.device).eval()
+        self.labels = [
+            self.model.config.id2label[i] for i in range(self.model.config.num_labels)
+        ]
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+    def score(self, images: List[Optional[Any]]) -> np.ndarray:
+        """Returns the probability of each label for each image, as a `(len(images),
+        len(labels))` array, with NaN scores for the missing images."""
+        scores = np.full((len(images), len(self.labels)), np.nan, dtype=np.float32)
+        present = [i for i, image in enumerate(images) if image is not None]
+        batches = [
+            present[start : start + self.batch_size]
+            for start in range(0, len(present), self.batch_size)
+        ]
+
+        ## The next batches are decoded while the model runs on the current one
+        pending: Deque[Tuple[List[int], Future]] = deque()
+        for indices in batches:
+            images_batch = [images[i] for i in indices]
+            pending.append(
+                (indices, self._executor.submit(self._preprocess, images_batch))
+            )
+            if len(pending) > self.num_threads:
+                self._score_batch(*pending.popleft(), scores)
+        while pending:
+            self._score_batch(*pending.popleft(), scores)
+        return scores
+
+    def top_labels(self, scores: np.ndarray) -> List[Optional[str]]:
+        """Returns the most likely label of each image, `None` for the missing ones."""
+        return _top_labels(scores, self.labels)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def _preprocess(self, images: List[Any]) -> torch.Tensor:
+        decoded = [load_image(image) for image in images]
+        return self.processor(images=decoded, return_tensors="pt")["pixel_values"]
+
+    @torch.inference_mode()
+    def _score_batch(
+        self, indices: List[int], pixel_values: Future, scores: np.ndarray
+    ) -> None:
+        logits = self.model(pixel_values=pixel_values.result().to(self.device)).logits
+        scores[indices] = logits.softmax(dim=-1).float().cpu().numpy()
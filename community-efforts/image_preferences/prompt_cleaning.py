@@ -0,0 +1,239 @@
+"""Helpers to clean the imgsys prompts batch by batch, without loading the full dataset in memory."""
+
+import hashlib
+import json
+import unicodedata
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datasets import load_dataset
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalizes the unicode characters, casing and whitespace of a prompt."""
+    return " ".join(unicodedata.normalize("NFKC", prompt).casefold().split())
+
+
+def prompt_fingerprint(prompt: str) -> int:
+    """Returns a stable 64-bit fingerprint of a prompt (unlike `hash`, it is the same across processes and runs)."""
+    digest = hashlib.blake2b(prompt.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def fingerprint_batch(prompts: List[str]) -> np.ndarray:
+    """Returns the fingerprints of a batch of prompts as a `np.uint64` array."""
+    return np.fromiter(
+        (prompt_fingerprint(prompt) for prompt in prompts),
+        dtype=np.uint64,
+        count=len(prompts),
+    )
+
+
+class FingerprintSet:
+    """A set of 64-bit fingerprints stored as a sorted `np.uint64` array, so 8 bytes per prompt
+    instead of the ~100 bytes a Python `set` of strings or ints would take."""
+
+    def __init__(self, fingerprints: Optional[np.ndarray] = None) -> None:
+        if fingerprints is None:
+            fingerprints = np.empty(0, dtype=np.uint64)
+        self.fingerprints = np.unique(np.asarray(fingerprints, dtype=np.uint64))
+
+    def __len__(self) -> int:
+        return len(self.fingerprints)
+
+    def save(self, path: Union[str, Path]) -> None:
+        np.save(path, self.fingerprints)
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "FingerprintSet":
+        fingerprint_set = cls()
+        fingerprint_set.fingerprints = np.load(path)
+        return fingerprint_set
+
+    def contains(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Returns a boolean mask with the fingerprints that are already in the set."""
+        if len(self.fingerprints) == 0:
+            return np.zeros(len(fingerprints), dtype=bool)
+        positions = np.searchsorted(self.fingerprints, fingerprints)
+        positions[positions == len(self.fingerprints)] = 0
+        return self.fingerprints[positions] == fingerprints
+
+    def add(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Adds a batch of fingerprints and returns a boolean mask with the ones seen for the
+        first time, keeping only the first occurrence of duplicates within the batch."""
+        _, first_positions = np.unique(fingerprints, return_index=True)
+        is_new = np.zeros(len(fingerprints), dtype=bool)
+        is_new[first_positions] = True
+        is_new &= ~self.contains(fingerprints)
+        if is_new.any():
+            # merging two sorted runs with timsort is linear, unlike `np.union1d`
+            self.fingerprints = np.sort(
+                np.concatenate([self.fingerprints, np.sort(fingerprints[is_new])]),
+                kind="stable",
+            )
+        return is_new
+
+
+class FingerprintIndex:
+    """Sorted index from prompt fingerprints to their row number in the exported dataset,
+    stored as two `.npy` files that can be memory-mapped, to look up or join prompts with a
+    binary search instead of rehashing and scanning the dataset."""
+
+    def __init__(self, fingerprints: np.ndarray, rows: np.ndarray) -> None:
+        self.fingerprints = fingerprints
+        self.rows = rows
+
+    @classmethod
+    def from_fingerprints(cls, fingerprints: np.ndarray) -> "FingerprintIndex":
+        """Builds the index of the fingerprints of the rows `0..len(fingerprints) - 1`."""
+        rows = np.argsort(fingerprints, kind="stable")
+        return cls(fingerprints[rows], rows)
+
+    def save(self, output_dir: Union[str, Path]) -> None:
+        np.save(Path(output_dir) / "prompt_fingerprints.npy", self.fingerprints)
+        np.save(Path(output_dir) / "prompt_fingerprint_rows.npy", self.rows)
+
+    @classmethod
+    def load(cls, output_dir: Union[str, Path]) -> "FingerprintIndex":
+        return cls(
+            np.load(Path(output_dir) / "prompt_fingerprints.npy", mmap_mode="r"),
+            np.load(Path(output_dir) / "prompt_fingerprint_rows.npy", mmap_mode="r"),
+        )
+
+    def extend(self, fingerprints: np.ndarray) -> "FingerprintIndex":
+        """Returns a new index with the given fingerprints appended as the next rows."""
+        fingerprints_by_row = np.empty(len(self.rows), dtype=np.uint64)
+        fingerprints_by_row[self.rows] = self.fingerprints
+        return FingerprintIndex.from_fingerprints(
+            np.concatenate([fingerprints_by_row, fingerprints])
+        )
+
+    def lookup(self, fingerprints: np.ndarray) -> np.ndarray:
+        """Returns the row of each fingerprint, or -1 for the ones not in the index."""
+        fingerprints = np.asarray(fingerprints, dtype=np.uint64)
+        if len(self.fingerprints) == 0:
+            return np.full(len(fingerprints), -1, dtype=np.int64)
+        positions = np.searchsorted(self.fingerprints, fingerprints)
+        positions[positions == len(self.fingerprints)] = 0
+        found = self.fingerprints[positions] == fingerprints
+        return np.where(found, self.rows[positions], -1)
+
+
+def iter_prompt_batches(
+    repo_id: str,
+    split: str = "train",
+    revision: Optional[str] = None,
+    batch_size: int = 100_000,
+    streaming: bool = False,
+    seed: Optional[int] = None,
+    skip_rows: int = 0,
+) -> Iterator[List[Optional[str]]]:
+    """Yields the `prompt` column of a Hub dataset in batches, reading only that column.
+
+    Without `streaming` the dataset is downloaded and memory-mapped, and the seeded shuffle
+    only creates an indices mapping, so for a given `revision` and `seed` the prompts are
+    always yielded in the same order without copying the data. With `streaming` nothing is
+    downloaded upfront and the shuffle is done with a buffer of `batch_size` rows.
+
+    The first `skip_rows` rows, e.g. the ones already processed in a previous run, are
+    skipped before shuffling, assuming new rows are only ever appended to the dataset.
+    """
+    dataset = load_dataset(repo_id, split=split, revision=revision, streaming=streaming)
+    dataset = dataset.select_columns(["prompt"])
+    if streaming:
+        dataset = dataset.skip(skip_rows)
+        dataset = dataset.shuffle(seed=seed, buffer_size=batch_size)
+    else:
+        if skip_rows > len(dataset):
+            raise ValueError(
+                f"Cannot skip {skip_rows} rows of '{repo_id}' as it only has"
+                f" {len(dataset)} rows, rows were removed so it has to be fully reprocessed."
+            )
+        if skip_rows == len(dataset):
+            # no rows were added since the previous run
+            return
+        dataset = dataset.select(range(skip_rows, len(dataset)))
+        dataset = dataset.shuffle(seed=seed)
+    for batch in dataset.iter(batch_size=batch_size):
+        yield batch["prompt"]
+
+
+class ParquetShardWriter:
+    """Writes tables to `<output_dir>/data/train-<index>.parquet` shards of exactly
+    `shard_size` rows (except the last one), flushing each shard to disk as soon as it is
+    full, so shards can be processed and resumed independently downstream.
+
+    When appending to a previous export, its manifest `shards` are given so the new shards
+    continue their numbering and row offsets.
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        shard_size: int = 500_000,
+        shards: Optional[List[Dict[str, Any]]] = None,
+    ) -> None:
+        self.output_dir = Path(output_dir)
+        self.data_dir = self.output_dir / "data"
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        for stale_shard in self.data_dir.glob("train-*.parquet"):
+            stale_shard.unlink()
+        self.shard_size = shard_size
+        self.shards: List[Dict[str, Any]] = list(shards or [])
+        self._buffer: List[pa.Table] = []
+        self._buffered_rows = 0
+
+    def write(self, table: pa.Table) -> None:
+        if table.num_rows == 0:
+            return
+        self._buffer.append(table)
+        self._buffered_rows += table.num_rows
+        while self._buffered_rows >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def close(self) -> List[Dict[str, Any]]:
+        if self._buffered_rows:
+            self._flush(self._buffered_rows)
+        return self.shards
+
+    def write_manifest(self, **metadata: Any) -> Path:
+        """Writes `<output_dir>/manifest.json` with the given metadata and the path, number
+        of rows and offset of each shard."""
+        manifest = {
+            **metadata,
+            "shard_size": self.shard_size,
+            "num_rows": sum(shard["num_rows"] for shard in self.shards),
+            "shards": self.shards,
+        }
+        path = self.output_dir / "manifest.json"
+        path.write_text(json.dumps(manifest, indent=2))
+        return path
+
+    @staticmethod
+    def read_manifest(output_dir: Path) -> Optional[Dict[str, Any]]:
+        path = Path(output_dir) / "manifest.json"
+        return json.loads(path.read_text()) if path.exists() else None
+
+    def _flush(self, num_rows: int) -> None:
+        buffered = pa.concat_tables(self._buffer)
+        path = self.data_dir / f"train-{len(self.shards):05d}.parquet"
+        pq.write_table(buffered.slice(0, num_rows), path)
+        self.shards.append(
+            {
+                "path": path.relative_to(self.output_dir).as_posix(),
+                "num_rows": num_rows,
+                "offset": sum(shard["num_rows"] for shard in self.shards),
+            }
+        )
+        rest = buffered.slice(num_rows)
+        self._buffer = [rest] if rest.num_rows else []
+        self._buffered_rows = rest.num_rows
+
+    def __enter__(self) -> "ParquetShardWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -0,0 +1,228 @@
+# Canonical copy, copied as is to the folders below so each of them runs on its own,
+# copy the changes made here to them:
+#   cookbook-efforts/dpo-orpo-preference/response_cache.py
+#   cookbook-efforts/domain-specific-datasets/distilabel_pipelines/response_cache.py
+"""Persistent cache of LLM responses, so reruns of a pipeline do not pay twice for the same tokens."""
+
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+from distilabel.llms import InferenceEndpointsLLM
+from distilabel.mixins.runtime_parameters import RuntimeParameter
+from pydantic import BaseModel, Field, PrivateAttr
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO stats VALUES ('size', 0);
+"""
+
+
+def cache_key(**request: Any) -> str:
+    """Returns the SHA-256 of the JSON serialized request, with the keys sorted so the key
+    does not depend on the order of the arguments or the generation kwargs."""
+    serialized = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed store of JSON responses in a SQLite database.
+
+    The total size of the stored responses is kept under `max_size` bytes by evicting the
+    least recently used ones. The database is opened in WAL mode, so the steps of a pipeline,
+    each running in its own process, can share the same file.
+    """
+
+    def __init__(self, path: Union[str, Path], max_size: int = 2 * 1024**3) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def __len__(self) -> int:
+        return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        return self._connection.execute(
+            "SELECT value FROM stats WHERE name = 'size'"
+        ).fetchone()[0]
+
+    def get_many(self, keys: List[str]) -> List[Optional[Any]]:
+        """Returns the response stored for each key, or `None` for the missing ones."""
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(
+                self._connection.execute(
+                    f"SELECT key, response FROM responses WHERE key IN ({placeholders})",
+                    chunk,
+                ).fetchall()
+            )
+        if found:
+            now = time.time()
+            self._connection.executemany(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                [(now, key) for key in found],
+            )
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, items: List[Tuple[str, Any]]) -> None:
+        """Stores a list of `(key, response)` pairs and evicts the least recently used
+        responses if the cache grows over `max_size`, all in a single transaction."""
+        if not items:
+            return
+        now = time.time()
+        with self._transaction() as connection:
+            for key, response in items:
+                serialized = json.dumps(response, ensure_ascii=False)
+                previous = connection.execute(
+                    "SELECT size FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                connection.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, serialized, len(serialized), now),
+                )
+                self._add_size(len(serialized) - (previous[0] if previous else 0))
+            self._evict()
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _add_size(self, delta: int) -> None:
+        self._connection.execute(
+            "UPDATE stats SET value = value + ? WHERE name = 'size'", (delta,)
+        )
+
+    def _evict(self) -> None:
+        excess = self.size - self.max_size
+        if excess <= 0:
+            return
+        evicted, freed = [], 0
+        for key, size in self._connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ):
+            evicted.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._add_size(-freed)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # the write lock is taken upfront, so concurrent writers wait instead of failing
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self._connection
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+
+class ResponseCacheMixin(BaseModel):
+    """Mixin caching the responses of an LLM in a `ResponseCache`, to be placed before the
+    LLM class in the bases, e.g. `class CachedLLM(ResponseCacheMixin, InferenceEndpointsLLM)`.
+
+    The key of each input is computed from `cache_namespace` (the model and endpoint), the
+    formatted input, the number of generations and the generation kwargs, so changing any of
+    them sends a new request. Only the inputs missing from the cache are sent to the LLM, in
+    a single `generate` call, and responses with failed (`None`) generations are not stored.
+    """
+
+    cache_path: Optional[RuntimeParameter[str]] = Field(
+        default=None,
+        description="The path of the SQLite database where the responses are cached, if"
+        " not provided the responses are not cached.",
+    )
+    cache_max_size: RuntimeParameter[int] = Field(
+        default=2 * 1024**3,
+        description="The maximum size in bytes of the cached responses, the least"
+        " recently used ones are evicted above it.",
+    )
+
+    _cache: Optional[ResponseCache] = PrivateAttr(default=None)
+
+    @property
+    def cache_namespace(self) -> Any:
+        """Identifies the model serving the responses, part of every cache key."""
+        return self.model_name
+
+    def load(self) -> None:
+        super().load()
+        if self.cache_path is not None:
+            self._cache = ResponseCache(self.cache_path, max_size=self.cache_max_size)
+
+    def unload(self) -> None:
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+        super().unload()
+
+    def generate(
+        self, inputs: List[Any], num_generations: int = 1, **kwargs: Any
+    ) -> List[Any]:
+        if self._cache is None:
+            return super().generate(
+                inputs=inputs, num_generations=num_generations, **kwargs
+            )
+
+        keys = [
+            cache_key(
+                namespace=self.cache_namespace,
+                input=input,
+                num_generations=num_generations,
+                generation_kwargs=kwargs,
+            )
+            for input in inputs
+        ]
+        outputs = self._cache.get_many(keys)
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            generated = super().generate(
+                inputs=[inputs[i] for i in missing],
+                num_generations=num_generations,
+                **kwargs,
+            )
+            for i, output in zip(missing, generated):
+                outputs[i] = output
+            self._cache.put_many(
+                [
+                    (keys[i], output)
+                    for i, output in zip(missing, generated)
+                    if all(generation is not None for generation in output)
+                ]
+            )
+        return outputs
+
+
+class CachedInferenceEndpointsLLM(ResponseCacheMixin, InferenceEndpointsLLM):
+    """`InferenceEndpointsLLM` caching its responses, see `ResponseCacheMixin`."""
+
+    @property
+    def cache_namespace(self) -> Any:
+        return {
+            "model_id": self.model_id,
+            "endpoint_name": self.endpoint_name,
+            "endpoint_namespace": self.endpoint_namespace,
+            "base_url": self.base_url,
+            "tokenizer_id": self.tokenizer_id,
+            # not a field of the distilabel versions before 1.1
+            "structured_output": getattr(self, "structured_output", None),
+        }
@@ -0,0 +1,61 @@
+"""Entry point of the synthetic data generation stages and the components they share.
+
+Run a stage with `python synthetic_data_generation.py {prompts,images,total}`. The
+components (`ImageGeneration`, `CategorySelector`, `categories`, ...) can be imported
+from this module, and the module defining each one, with distilabel, PIL or numpy, is
+only imported when the component is first used, so parsing the arguments or importing
+the categories does not pay for them.
+"""
+
+import argparse
+import importlib
+import runpy
+import sys
+from pathlib import Path
+from typing import Any, List, Optional
+
+STAGES = {
+    "prompts": "01_synthetic_data_generation_prompts.py",
+    "images": "01_synthetic_data_generation_images.py",
+    "total": "01_synthetic_data_generation_total.py",
+}
+
+_COMPONENTS = {
+    "categories": "categories",
+    "excluded_categories": "categories",
+    "CategorySelector": "category_selector",
+    "ImageGeneration": "image_generation",
+    "InferenceEndpointsImageLLM": "image_generation",
+    "ImageStore": "image_store",
+    "ConcurrentInferenceEndpointsLLM": "llms",
+    "CachedConcurrentInferenceEndpointsLLM": "llms",
+}
+
+__all__ = ["STAGES", "main", *_COMPONENTS]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _COMPONENTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_COMPONENTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "stage",
+        choices=STAGES,
+        help="prompts: generate the style, quality and simplified prompts; images:"
+        " generate the images of the generated prompts; total: both in one pipeline.",
+    )
+    args = parser.parse_args(argv)
+
+    script = Path(__file__).parent / STAGES[args.stage]
+    sys.path.insert(0, str(script.parent))
+    runpy.run_path(str(script), run_name="__main__")
+
+
+if __name__ == "__main__":
+    main()
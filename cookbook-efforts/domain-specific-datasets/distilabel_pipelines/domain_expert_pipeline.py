@@ -2,7 +2,6 @@ import json
 from typing import Any, Dict
 
 import argilla as rg
-from distilabel.llms import InferenceEndpointsLLM
 from distilabel.pipeline import Pipeline
 from distilabel.steps import (
     LoadDataFromDicts,
@@ -16,6 +15,7 @@ from distilabel.steps.tasks import (
 from distilabel.steps.tasks.typing import ChatType
 from huggingface_hub import hf_hub_download
 
+from response_cache import CachedInferenceEndpointsLLM
 
 ################################################################################
 # Define custom Argilla Dataset
@@ -123,6 +123,7 @@ if __name__ == "__main__":
     domain_expert_temperature = params.get("domain_expert_temperature", 0.9)
     self_instruct_max_new_tokens = params.get("self_instruct_max_new_tokens", 2048)
     domain_expert_max_new_tokens = params.get("domain_expert_max_new_tokens", 2048)
+    response_cache_path = params.get("response_cache_path", "cache/responses.sqlite")
 
     if not all(
         [
@@ -171,9 +172,10 @@ if __name__ == "__main__":
             name="self_instruct",
             num_instructions=self_intruct_num_generations,
             input_batch_size=8,
-            llm=InferenceEndpointsLLM(
+            llm=CachedInferenceEndpointsLLM(
                 api_key=hub_token,
                 base_url=self_instruct_base_url,
+                cache_path=response_cache_path,
             ),
             application_description=application_instruction,
         )
@@ -186,9 +188,10 @@ if __name__ == "__main__":
 
         domain_expert = DomainExpert(
             name="domain_expert",
-            llm=InferenceEndpointsLLM(
+            llm=CachedInferenceEndpointsLLM(
                 api_key=hub_token,
                 base_url=domain_expert_base_url,
+                cache_path=response_cache_path,
             ),
             input_batch_size=8,
             num_generations=domain_expert_num_generations,
@@ -1,10 +1,10 @@
 import os
 import time
+from functools import lru_cache
 from typing import Any, Dict
 
 import argilla as rg
 from custom_preference_to_argilla import CustomPreferenceToArgilla
-from distilabel.llms import InferenceEndpointsLLM
 from distilabel.pipeline import Pipeline
 from distilabel.steps import (
     LoadHubDataset,
@@ -15,7 +15,10 @@ from distilabel.steps import (
 from distilabel.steps.tasks import TextGeneration, UltraFeedback
 from distilabel.steps.tasks.typing import ChatType
 from dotenv import load_dotenv
-from huggingface_hub import InferenceClient, login
+from huggingface_hub import hf_hub_download, login
+
+from language_detection import LanguageDetector
+from response_cache import CachedInferenceEndpointsLLM
 
 load_dotenv()
 
@@ -33,6 +36,9 @@ MAX_NEW_TOKENS = 2000  # Maximum number of new tokens to generate
 # Inference Endpoints Configuration
 # INFERENCE_ENDPOINTS_URL = "https://api-inference.huggingface.co/models/meta-llama/Meta-Llama-3-70B-Instruct"  # Inference endpoints URL
 # ENDPOINT_NAME = "meta-llama/Meta-Llama-3-70B-Instruct"
+LANGUAGE_DETECTION_MODEL_ID = "laurievb/OpenLID"  # fastText language identification model run locally, predicting labels such as nld_Latn for 201 languages
+LANGUAGE_DETECTION_NUM_PROC = 1  # Number of processes used to predict the language of the generations, steps already run in their own process
+RESPONSE_CACHE_PATH = "cache/responses.sqlite"  # Where the model responses are cached, so rerunning the pipeline does not request them again, set to None to disable the cache
 INPUT_BATCH_SIZE = 10  # Input batch size `for the model via the Inference Endpoints API, you can adjust this based on the model's requirements and the hardware you are using to deploy the model
 
 # Argilla Configuration
@@ -86,6 +92,15 @@ def remove_existing_dataset(argilla_dataset_name: str):
 #####################################
 
 
+@lru_cache(maxsize=None)
+def language_detector() -> LanguageDetector:
+    """Returns the language detector, downloading and loading OpenLID once per process."""
+    return LanguageDetector(
+        num_proc=LANGUAGE_DETECTION_NUM_PROC,
+        model_path=hf_hub_download(LANGUAGE_DETECTION_MODEL_ID, "model.bin"),
+    )
+
+
 @step(
     inputs=["generation"],
     outputs=["predicted_generation_language", "predicted_generation_language_score"],
@@ -94,23 +109,19 @@ def language_predict(inputs: StepInput) -> StepOutput:
     """
     A step to predict the language of the generated text.
     Sometimes models fail to generate text in the desired language.
-    This step helps to identify such cases using an external language prediction model.
+    This step helps to identify such cases using the OpenLID language prediction model,
+    run locally on the whole batch at once.
     """
-    for input in inputs:
-        try:
-            cleaned_input = input["generation"].replace("\n", " ")
-            resp = InferenceClient("laurievb/OpenLID").text_classification(
-                cleaned_input
-            )
-            top_prediction = resp[0]  # top prediction is the first element in the list
-            input["predicted_generation_language"] = top_prediction.label
-            input["predicted_generation_language_score"] = min(
-                1.0, top_prediction.score
-            )  # ensure score is between 0 and 1
-        except Exception as e:
-            print(e)
-            input["predicted_generation_language"] = "error"
-            input["predicted_generation_language_score"] = 0.0
+    generations = [input["generation"] for input in inputs]
+    # the generations that cannot be detected, e.g. missing, get the "error" language
+    languages, scores = language_detector().detect(generations)
+    for input, language, score in zip(
+        inputs, languages.to_pylist(), scores.to_pylist()
+    ):
+        input["predicted_generation_language"] = language
+        input["predicted_generation_language_score"] = min(
+            1.0, score
+        )  # ensure score is between 0 and 1
     yield inputs
 
 
@@ -164,11 +175,12 @@ with Pipeline(name="generate-dpo-responses") as pipeline:
     #####################################
     # Define the LLM
     #####################################
-    llm = InferenceEndpointsLLM(
+    llm = CachedInferenceEndpointsLLM(
         model_id=MODEL_ID,
         tokenizer_id=MODEL_ID,
         model_display_name=MODEL_ID,
         api_key=HUGGINGFACE_TOKEN,
+        cache_path=RESPONSE_CACHE_PATH,
     )
     # Generate responses using the model
     text_generation = DutchTextGeneration(